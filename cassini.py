@@ -7,16 +7,27 @@
 # License: MIT
 #
 import os
+import atexit
 import pprint
 import socket
 import sys
 import time
+import tempfile
 import asyncio
 import logging
 import argparse
 from simple_mqtt_server import SimpleMQTTServer
 from simple_http_server import SimpleHTTPServer
-from saturn_printer import SaturnPrinter, PrintInfoStatus, CurrentStatus, FileStatus
+from simple_mqtt_client import SimpleMQTTClient
+from mqtt_bridge import MQTTBridge
+from status_poller import StatusPoller
+from discovery import Discovery
+from status_period import StatusPeriodPolicy
+from session_replayer import SessionReplayer
+from transfer_tuning import TransferTuning, describe_profile
+from hotfolder import HotFolder
+import session_recorder
+from saturn_printer import PrintInfoStatus, CurrentStatus, FileStatus, Command
 
 logging.basicConfig(
     level=logging.INFO,
@@ -46,7 +57,9 @@ async def create_mqtt_server():
     return mqtt, mqtt.port, mqtt_server_task
 
 async def create_http_server():
-    http = SimpleHTTPServer('0.0.0.0', 0)
+    tuning = TransferTuning()
+    tuning.load()
+    http = SimpleHTTPServer('0.0.0.0', 0, tuning=tuning)
     await http.start()
     http_server_task = asyncio.create_task(http.serve_forever())
     return http, http.port, http_server_task
@@ -59,29 +72,58 @@ def do_status(printers):
         file_info = status['FileTransferInfo']
         print(f"{p.addr[0]}:")
         print(f"    {attrs['Name']} ({attrs['MachineName']})")
-        print(f"    Machine Status: {CurrentStatus(status['CurrentStatus']).name}")
-        print(f"    Print Status: {PrintInfoStatus(print_info['Status']).name}")
+        print(f"    Machine Status: {status_name(CurrentStatus, status['CurrentStatus'])}")
+        print(f"    Print Status: {status_name(PrintInfoStatus, print_info['Status'])}")
         print(f"    Layers: {print_info['CurrentLayer']}/{print_info['TotalLayer']}")
         print(f"    File: {print_info['Filename']}")
-        print(f"    File Transfer Status: {FileStatus(file_info['Status']).name}")
+        print(f"    File Transfer Status: {status_name(FileStatus, file_info['Status'])}")
+
+# Name of a status code, or the number for ones we don't know yet (e.g. an
+# idle printer's print status of 0)
+def status_name(enum, value):
+    try:
+        return enum(value).name
+    except ValueError:
+        return str(value)
 
 def do_status_full(printers):
     for i, p in enumerate(printers):
         pprint.pprint(p.desc)
 
 
-def do_watch(printer, interval=5, broadcast=None):
+async def do_watch(printer, interval=5):
     status = printer.status()
-    with alive_bar(total=status['totalLayers'], manual=True, elapsed=False, title=status['filename']) as bar:
-        while True:
-            printers = SaturnPrinter.find_printers(broadcast=broadcast)
-            if len(printers) > 0:
-                status = printers[0].status()
-                pct = status['currentLayer'] / status['totalLayers']
-                bar(pct)
-                if pct >= 1.0:
-                    break
-            time.sleep(interval)
+    async with StatusPoller() as poller:
+        with alive_bar(total=status['totalLayers'], manual=True, elapsed=False, title=status['filename']) as bar:
+            while True:
+                if await poller.refresh([printer], force=True):
+                    status = printer.status()
+                    pct = status['currentLayer'] / status['totalLayers']
+                    bar(pct)
+                    if pct >= 1.0:
+                        break
+                await asyncio.sleep(interval)
+
+async def find_printers_by_address(addrs):
+    ips = []
+    for addr in addrs:
+        try:
+            ips.append(socket.gethostbyname(addr))
+        except socket.gaierror:
+            logging.error(f"Can't resolve printer address {addr}")
+    async with StatusPoller() as poller:
+        printers = await poller.find_printers(ips)
+    found = [p.addr[0] for p in printers]
+    for ip in ips:
+        if ip not in found:
+            logging.error(f"No response from printer {ip}")
+    return printers
+
+async def discover_printers(broadcast=None, sweep=None, sweep_rate=None):
+    discovery = Discovery(sweep_rate=sweep_rate)
+    targets = [('0.0.0.0', b) for b in broadcast.split(',')] if broadcast else None
+    networks = sweep.split(',') if sweep else None
+    return await discovery.discover(targets, networks)
 
 async def create_servers():
     mqtt, mqtt_port, mqtt_task = await create_mqtt_server()
@@ -114,30 +156,202 @@ async def do_upload(printer, filename, start_printing=False):
         logging.error("Failed to connect to printer")
         sys.exit(1)
     
-    #await printer.upload_file(filename, start_printing=start_printing)
-    upload_task = asyncio.create_task(printer.upload_file(filename, start_printing=start_printing))
-    # grab the first one, because we want the file size
     basename = filename.split('\\')[-1].split('/')[-1]
     file_size = os.path.getsize(filename)
     with alive_bar(total=file_size, manual=True, elapsed=False, title=basename) as bar:
-        while True:
-            if printer.file_transfer_future is None:
-                await asyncio.sleep(0.1)
-                continue
-            progress = await printer.file_transfer_future
-            if progress[0] < 0:
-                logging.error("File upload failed!")
-                sys.exit(1)
-            bar(progress[0] / progress[1])
-            if progress[0] >= progress[1]:
-                break
-    await upload_task
+        try:
+            async for progress in printer.upload(filename, start_printing=start_printing, abort_on_bad_ack=True):
+                if progress[0] < 0:
+                    logging.error("File upload failed!")
+                    sys.exit(1)
+                if progress[1] > 0:
+                    bar(progress[0] / progress[1])
+        except asyncio.TimeoutError:
+            logging.error("File upload failed! (no response from printer)")
+            sys.exit(1)
+        except ConnectionError as ex:
+            logging.error(f"File upload failed! ({ex})")
+            sys.exit(1)
+    http.tuning.save()
+
+async def do_bridge(printers, address, prefix, min_interval, stats_interval=60):
+    upstream_host, upstream_port = address.split(':')
+    upstream = SimpleMQTTClient(upstream_host, upstream_port, f"cassini-{os.getpid()}")
+    await upstream.connect()
+
+    mqtt, http = await create_servers()
+    for p in printers:
+        connected = await p.connect(mqtt, http)
+        if not connected:
+            logging.error(f"Failed to connect to printer {p.describe()}")
+            sys.exit(1)
+        logging.info(f"Bridging {p.describe()} ({p.addr[0]})")
+
+    bridge = MQTTBridge(mqtt, upstream, prefix=prefix, min_interval=min_interval)
+    bridge_task = asyncio.create_task(bridge.run())
+    reattach_tasks = [asyncio.create_task(keep_attached(p, mqtt, http)) for p in printers]
+
+    next_stats = time.monotonic() + stats_interval
+    while True:
+        closed_task = asyncio.ensure_future(upstream.closed.wait())
+        await asyncio.wait([bridge_task, closed_task], timeout=max(0, next_stats - time.monotonic()), return_when=asyncio.FIRST_COMPLETED)
+        closed_task.cancel()
+        if bridge_task.done():
+            for task in reattach_tasks:
+                task.cancel()
+            if not bridge_task.cancelled() and bridge_task.exception() is not None:
+                logging.error(f"Bridge failed: {bridge_task.exception()!r}")
+            else:
+                logging.error("Bridge stopped")
+            sys.exit(1)
+        if upstream.closed.is_set():
+            logging.warning("Lost connection to upstream MQTT broker, reconnecting")
+            await reconnect_upstream(upstream)
+            bridge.republish()
+        if time.monotonic() >= next_stats:
+            next_stats += stats_interval
+            stats = bridge.stats()
+            ratio = f"{stats['ratio']:.1f}" if stats['ratio'] is not None else "-"
+            logging.info(f"Bridge: received {stats['received']}, published {stats['published']} in {stats['writes']} writes (ratio {ratio})")
+
+# Tell a printer whose MQTT connection dropped (e.g. it rebooted or left the
+# network) to connect again, for as long as the bridge runs
+async def keep_attached(printer, mqtt, http, interval=10):
+    while True:
+        await asyncio.sleep(interval)
+        if mqtt.is_connected(printer.id):
+            continue
+        logging.warning(f"Lost connection to {printer.describe()}, reconnecting")
+        try:
+            await printer.connect(mqtt, http)
+        except (asyncio.TimeoutError, OSError, ConnectionError) as e:
+            logging.warning(f"Can't reconnect to {printer.describe()}: {e!r}")
+            continue
+        if mqtt.is_connected(printer.id):
+            logging.info(f"Reconnected to {printer.describe()}")
+
+async def reconnect_upstream(upstream, max_delay=60):
+    delay = 1
+    while True:
+        await asyncio.sleep(delay)
+        try:
+            await upstream.connect()
+        except (OSError, ConnectionError, asyncio.IncompleteReadError) as e:
+            logging.warning(f"Can't reconnect to upstream MQTT broker: {e}")
+            delay = min(delay * 2, max_delay)
+            continue
+        logging.info("Reconnected to upstream MQTT broker")
+        return
+
+async def do_hotfolder(printers, directory, stable_time, workers, include_existing):
+    if not os.path.isdir(directory):
+        logging.error(f"{directory} is not a directory")
+        sys.exit(1)
+
+    mqtt, http = await create_servers()
+    for p in printers:
+        connected = await p.connect(mqtt, http)
+        if not connected:
+            logging.error(f"Failed to connect to printer {p.describe()}")
+            sys.exit(1)
+
+    folder = HotFolder(directory, printers, stable_time=stable_time, workers=workers, include_existing=include_existing)
+    await folder.run()
+
+async def do_replay(filename, fast=False):
+    replayer = SessionReplayer(filename, fast=fast)
+    stats = await replayer.replay()
+    print(f"{filename}: {stats['records']} records, {stats['printers']} printers")
+    print(f"    Replayed in {stats['replay_duration']:.2f}s (recorded over {stats['recorded_duration']:.2f}s)")
+    print(f"    MQTT frames: {stats['mqtt_frames']} ({stats['statuses']} status)")
+    print(f"    HTTP requests: {stats['http_requests']}, {stats['http_bytes']} bytes")
+    if stats['http_throughput'] is not None:
+        print(f"    HTTP throughput: {stats['http_throughput'] / 1e6:.2f} MB/s")
+    if stats['recorded_http_throughput'] is not None:
+        print(f"    Recorded HTTP throughput: {stats['recorded_http_throughput'] / 1e6:.2f} MB/s")
+
+# Settings tried by bench-transfer, one at a time, keeping the best value of each
+BENCH_SWEEP = [
+    ('sndbuf', [None, 64 * 1024, 256 * 1024, 1024 * 1024, 4 * 1024 * 1024]),
+    ('nodelay', [False, True]),
+    ('notsent_lowat', [None, 16 * 1024, 128 * 1024]),
+    ('chunk_size', [64 * 1024, 256 * 1024, 1024768]),
+]
+
+async def do_bench_transfer(printer, size, simulator=False, download_rate=None):
+    if simulator:
+        from printer_simulator import SimulatedPrinter
+        # on a free port, so it doesn't clash with simulators already running;
+        # a fixed ID keeps the tuning file from collecting one entry per run
+        sim = SimulatedPrinter('127.0.0.1', 0, mainboard_id='0000benchsim0000', download_rate=download_rate)
+        await sim.start()
+        async with StatusPoller(port=sim.port) as poller:
+            printers = await poller.find_printers([sim.host])
+        printer = printers[0]
+
+    mqtt, http = await create_servers()
+    connected = await printer.connect(mqtt, http)
+    if not connected:
+        logging.error("Failed to connect to printer")
+        sys.exit(1)
+    # report as often as possible, so the end of each transfer is seen promptly
+    await printer.send_command_and_wait(Command.SET_MYSTERY_TIME_PERIOD, { 'TimePeriod': 500 })
+    mqtt.set_status_period(printer.id, 500)
+
+    tuning = http.tuning
+    tuning.set_client_id(printer.addr[0], printer.id)
+
+    # Every transfer uses the same name, so each one replaces the last on the
+    # printer and only one file is left behind; the contents are new each
+    # time, so the printer can't skip a transfer it has already done
+    tempdir = tempfile.TemporaryDirectory(prefix='cassini-bench-')
+    filename = os.path.join(tempdir.name, 'cassini-bench.goo')
+
+    results = {}
+    async def measure(profile):
+        key = describe_profile(profile)
+        if key not in results:
+            tuning.set_profile(printer.id, profile)
+            with open(filename, 'wb') as f:
+                f.write(os.urandom(size))
+            start = time.monotonic()
+            async for progress in printer.upload(filename):
+                if progress[0] < 0:
+                    logging.error("File upload failed!")
+                    sys.exit(1)
+            rate = size / (time.monotonic() - start)
+            results[key] = rate
+            server_rate = http.throughput.get(printer.addr[0], 0)
+            print(f"{rate / 1e6:8.2f} MB/s ({server_rate / 1e6:8.2f} MB/s sent)  {key}")
+        return results[key]
+
+    with tempdir:
+        best = tuning.profile_for(printer.addr[0])
+        best_rate = await measure(best)
+        for name, values in BENCH_SWEEP:
+            for value in values:
+                candidate = dict(best, **{ name: value })
+                rate = await measure(candidate)
+                # don't switch away from what we have over noise
+                if rate > best_rate * 1.02:
+                    best, best_rate = candidate, rate
+
+    print(f"Best: {best_rate / 1e6:.2f} MB/s with {describe_profile(best)}")
+    tuning.set_profile(printer.id, best)
+    tuning.save()
+    await printer.send_command_and_wait(Command.SET_MYSTERY_TIME_PERIOD, { 'TimePeriod': 5000 })
+    mqtt.set_status_period(printer.id, 5000)
 
 def main():
     parser = argparse.ArgumentParser(prog='cassini', description='ELEGOO Saturn printer control utility')
-    parser.add_argument('-p', '--printer', help='ID of printer to target')
-    parser.add_argument('--broadcast', help='Explicit broadcast IP address')
+    parser.add_argument('-p', '--printer', help='Address of printer to target, or a comma-separated list of addresses')
+    parser.add_argument('--broadcast', help='Explicit broadcast IP address, or a comma-separated list (default: every interface)')
+    parser.add_argument('--sweep', metavar='CIDR', help='Also look for printers at every address in these networks, e.g. "10.1.4.0/22,10.2.0.0/24"')
+    parser.add_argument('--sweep-rate', type=float, help=f'Max --sweep requests/second (default {Discovery.SweepRate})')
     parser.add_argument('--debug', help='Enable debug logging', action='store_true')
+    parser.add_argument('--adaptive-status', help='Adapt how often printers report status to what they are doing', action='store_true')
+    parser.add_argument('--record', metavar='FILE', help='Record all printer traffic to a session log')
+    parser.add_argument('--status-budget', type=float, help='With --adaptive-status, max status messages/second across all printers')
 
     subparsers = parser.add_subparsers(title="commands", dest="command", required=True)
 
@@ -157,27 +371,68 @@ def main():
     parser_connect_mqtt = subparsers.add_parser('connect-mqtt', help='Connect printer to particular MQTT server')
     parser_connect_mqtt.add_argument('address', help='MQTT host and port, e.g. "192.168.1.33:1883" or "mqtt.local:1883"')
 
+    parser_bridge = subparsers.add_parser('bridge', help='Republish printer status to an upstream MQTT broker')
+    parser_bridge.add_argument('address', help='Upstream MQTT host and port, e.g. "mqtt.local:1883"')
+    parser_bridge.add_argument('--prefix', help='Upstream topic prefix', default='cassini')
+    parser_bridge.add_argument('--min-interval', type=float, help='Minimum seconds between publishes of the same topic', default=5.0)
+
+    parser_bench = subparsers.add_parser('bench-transfer', help='Find the fastest socket settings for file transfers to a printer')
+    parser_bench.add_argument('--size', type=int, help='Size of the test file in MB', default=16)
+    parser_bench.add_argument('--simulator', help='Benchmark against a local simulated printer', action='store_true')
+    parser_bench.add_argument('--download-rate', type=float, help='With --simulator, throttle its downloads to this many bytes/second')
+
+    parser_hotfolder = subparsers.add_parser('hotfolder', help='Upload files dropped into a directory to the printer(s)')
+    parser_hotfolder.add_argument('--stable-time', type=float, help='Seconds a file must be unchanged before it is sent', default=HotFolder.StableTime)
+    parser_hotfolder.add_argument('--workers', type=int, help='Files to fingerprint at once', default=HotFolder.Workers)
+    parser_hotfolder.add_argument('--existing', help='Also upload files already in the directory', action='store_true')
+    parser_hotfolder.add_argument('directory', help='Directory to watch')
+
+    parser_replay = subparsers.add_parser('replay', help='Replay a recorded session log against local servers')
+    parser_replay.add_argument('--fast', help='Replay as fast as possible instead of at the recorded pace', action='store_true')
+    parser_replay.add_argument('filename', help='Session log to replay')
+
     args = parser.parse_args()
 
     if args.debug:
         logging.getLogger().setLevel(logging.DEBUG)
 
+    if args.command == "replay":
+        asyncio.run(do_replay(args.filename, fast=args.fast))
+        sys.exit(0)
+
+    if args.command == "bench-transfer" and args.simulator:
+        asyncio.run(do_bench_transfer(None, args.size * 1024 * 1024, simulator=True, download_rate=args.download_rate))
+        sys.exit(0)
+
+    if args.record:
+        session_recorder.start(args.record)
+        atexit.register(session_recorder.stop)
+
     printers = []
     printer = None
     broadcast = args.broadcast
     if args.printer:
-        printer = SaturnPrinter.find_printer(args.printer)
-        if printer is None:
-            logging.error(f"No response from printer {args.printer}")
+        addrs = args.printer.split(',')
+        printers = asyncio.run(find_printers_by_address(addrs))
+        if len(printers) < len(set(addrs)):
             sys.exit(1)
-        printers = [printer]
+        printer = printers[0]
     else:
-        printers = SaturnPrinter.find_printers(broadcast=broadcast)
+        try:
+            printers = asyncio.run(discover_printers(broadcast, args.sweep, args.sweep_rate))
+        except ValueError as e:
+            logging.error(f"Bad --sweep: {e}")
+            sys.exit(1)
         if len(printers) == 0:
             logging.error("No printers found on network")
             sys.exit(1)
         printer = printers[0]
 
+    if args.adaptive_status:
+        policy = StatusPeriodPolicy(budget=args.status_budget)
+        for p in printers:
+            p.period_policy = policy
+
     if args.command == "status":
         do_status(printers)
         sys.exit(0)
@@ -196,7 +451,18 @@ def main():
             p.connect_mqtt(mqtt_host, mqtt_port)
 
     if args.command == "watch":
-        do_watch(printer, interval=args.interval, broadcast=broadcast)
+        asyncio.run(do_watch(printer, interval=args.interval))
+        sys.exit(0)
+
+    if args.command == "bridge":
+        asyncio.run(do_bridge(printers, args.address, args.prefix, args.min_interval))
+        sys.exit(0)
+
+    if args.command == "hotfolder":
+        try:
+            asyncio.run(do_hotfolder(printers, args.directory, args.stable_time, args.workers, args.existing))
+        except KeyboardInterrupt:
+            pass
         sys.exit(0)
 
     logging.info(f'Printer: {printer.describe()} ({printer.addr[0]})')
@@ -208,5 +474,7 @@ def main():
         asyncio.run(do_upload(printer, args.filename, start_printing=args.start_printing))
     elif args.command == "print":
         asyncio.run(do_print(printer, args.filename))
+    elif args.command == "bench-transfer":
+        asyncio.run(do_bench_transfer(printer, args.size * 1024 * 1024))
 
 main()
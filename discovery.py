@@ -0,0 +1,130 @@
+#
+# Cassini
+#
+# Copyright (C) 2023 Vladimir Vukicevic
+# License: MIT
+#
+
+import json
+import asyncio
+import logging
+import ipaddress
+
+import session_recorder
+from session_recorder import DIR_IN, REC_UDP
+from saturn_printer import SaturnPrinter, SATURN_UDP_PORT
+from status_poller import StatusPoller
+from network_interfaces import broadcast_targets
+
+class DiscoveryProtocol(asyncio.DatagramProtocol):
+    def __init__(self, discovery):
+        self.discovery = discovery
+
+    def datagram_received(self, data, addr):
+        self.discovery.incoming(data, addr)
+
+    def error_received(self, exc):
+        logging.debug(f"Discovery socket error: {exc}")
+
+# Finds printers by broadcasting M99999 out of every local interface at
+# once (rather than only the default route's), and optionally by sweeping
+# address ranges with unicast requests, for printers on networks that
+# broadcasts don't reach. A printer that answers more than once, e.g. on
+# two interfaces or to both a broadcast and the sweep, is only listed once,
+# by MainboardID.
+class Discovery:
+    Timeout = 1
+    # broadcasts are repeated this often within the timeout, in case one is lost
+    BroadcastInterval = 0.4
+    # requests/second for sweeps, and how long each address gets to answer
+    SweepRate = 1000
+    SweepTimeout = 2
+    # sweeps larger than this are probably a typo
+    MaxSweepSize = 65536
+
+    def __init__(self, timeout=None, port=SATURN_UDP_PORT, sweep_rate=None):
+        self.timeout = timeout or self.Timeout
+        self.port = port
+        self.sweep_rate = sweep_rate or self.SweepRate
+        # MainboardID -> SaturnPrinter
+        self.printers = {}
+
+    def incoming(self, data, addr):
+        session_recorder.record(REC_UDP, DIR_IN, addr, data)
+        try:
+            desc = json.loads(data.decode('utf-8'))
+        except ValueError:
+            logging.debug(f"Discovery: bad reply from {addr}")
+            return
+        self.add(addr, desc)
+
+    def add(self, addr, desc):
+        try:
+            mainboard_id = desc['Data']['Attributes']['MainboardID']
+        except (KeyError, TypeError):
+            logging.debug(f"Discovery: unexpected reply from {addr}")
+            return
+        if mainboard_id not in self.printers:
+            logging.debug(f"Discovery: found {mainboard_id} at {addr[0]}")
+            self.printers[mainboard_id] = SaturnPrinter(addr, desc)
+
+    # Broadcast from each (local address, broadcast address) target; by
+    # default, every interface that can broadcast
+    async def broadcast(self, targets=None):
+        if targets is None:
+            targets = broadcast_targets()
+        await asyncio.gather(*[self.broadcast_one(local, broadcast) for local, broadcast in targets])
+
+    async def broadcast_one(self, local, broadcast):
+        loop = asyncio.get_running_loop()
+        try:
+            transport, _ = await loop.create_datagram_endpoint(
+                lambda: DiscoveryProtocol(self), local_addr=(local, 0), allow_broadcast=True)
+        except OSError as e:
+            logging.warning(f"Can't broadcast from {local}: {e}")
+            return
+        logging.debug(f"Discovery: broadcasting to {broadcast} from {local}")
+        try:
+            deadline = loop.time() + self.timeout
+            while True:
+                transport.sendto(b'M99999', (broadcast, self.port))
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                await asyncio.sleep(min(remaining, self.BroadcastInterval))
+        except OSError as e:
+            logging.warning(f"Can't broadcast to {broadcast}: {e}")
+        finally:
+            transport.close()
+
+    # Unicast poll every host address in the given networks ("10.1.4.0/22"),
+    # through one socket, at no more than sweep_rate requests/second
+    async def sweep(self, networks):
+        ips = []
+        for network in networks:
+            network = ipaddress.ip_network(network, strict=False)
+            if len(ips) + network.num_addresses > self.MaxSweepSize:
+                raise ValueError(f"Refusing to sweep more than {self.MaxSweepSize} addresses")
+            ips.extend(str(ip) for ip in network.hosts())
+        ips = list(dict.fromkeys(ips))
+
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        async with StatusPoller(timeout=self.SweepTimeout, port=self.port, rate=self.sweep_rate) as poller:
+            results = await poller.poll(ips, force=True)
+        for result in results.values():
+            if result is not None:
+                self.add(*result)
+        found = sum(1 for r in results.values() if r is not None)
+        logging.debug(f"Discovery: swept {len(ips)} addresses in {loop.time() - start:.1f}s, {found} answered")
+
+    # Broadcast and sweep at the same time; returns the SaturnPrinters found,
+    # in address order
+    async def discover(self, targets=None, networks=None, broadcast=True):
+        tasks = []
+        if broadcast:
+            tasks.append(self.broadcast(targets))
+        if networks:
+            tasks.append(self.sweep(networks))
+        await asyncio.gather(*tasks)
+        return sorted(self.printers.values(), key=lambda p: ipaddress.ip_address(p.addr[0]))
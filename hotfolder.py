@@ -0,0 +1,263 @@
+#
+# Cassini
+#
+# Copyright (C) 2023 Vladimir Vukicevic
+# License: MIT
+#
+
+import os
+import sys
+import time
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from simple_http_server import fingerprint_file
+
+try:
+    from inotify_simple import INotify, flags as inotify_flags
+except ImportError:
+    INotify = None
+
+# Watches a directory for new print files and uploads each one to whichever
+# of the given (connected) printers is free first.
+#
+# A file is picked up once its size and mtime have stayed the same for
+# stable_time seconds, so half-copied files from a slicer or a network share
+# aren't sent. It is then hashed in a worker thread; the same size and MD5
+# are used to dedupe (the same content is only uploaded once, whatever it's
+# called) and for the HTTP route the printer downloads it from, so each file
+# is only read once before the transfer.
+#
+# Each printer takes one file at a time, and only while it isn't busy. A
+# failed upload is retried, possibly on another printer.
+class HotFolder:
+    Extensions = ('.goo', '.ctb')
+    StableTime = 5.0
+    PollInterval = 2.0
+    # with inotify, still rescan now and then: files written to a network
+    # share by another machine don't generate events here
+    RescanInterval = 30.0
+    Workers = 2
+    Retries = 2
+
+    def __init__(self, directory, printers, stable_time=None, workers=None, include_existing=False):
+        self.directory = directory
+        self.printers = printers
+        self.stable_time = stable_time if stable_time is not None else self.StableTime
+        self.include_existing = include_existing
+        self.executor = ThreadPoolExecutor(max_workers=workers or self.Workers)
+        self.inotify = None
+        self.changed = asyncio.Event()
+
+        # path -> ((size, mtime), loop time it was last seen to change)
+        self.candidates = {}
+        # path -> (size, mtime) of files already taken (or there at startup)
+        self.handled = {}
+        # md5 -> path of every file uploaded or queued
+        self.fingerprints = {}
+        # (path, fileinfo, attempt) ready to upload
+        self.queue = asyncio.Queue()
+        # printers free to take a file
+        self.idle = asyncio.Queue()
+        self.tasks = set()
+
+        self.uploaded = 0
+        self.failed = 0
+        self.duplicates = 0
+
+    async def run(self):
+        self.start_watching()
+        if not self.include_existing:
+            for path, key in self.scan_directory().items():
+                self.handled[path] = key
+        for p in self.printers:
+            self.release(p)
+        dispatchers = [asyncio.create_task(self.dispatch()) for p in self.printers]
+        logging.info(f"Watching {self.directory} for {', '.join(self.Extensions)} files ({'inotify' if self.inotify else 'polling'})")
+        try:
+            await self.watch()
+        finally:
+            for task in dispatchers + list(self.tasks):
+                task.cancel()
+            self.stop_watching()
+            self.executor.shutdown(wait=False)
+
+    def start_watching(self):
+        if INotify is None:
+            if sys.platform.startswith('linux'):
+                logging.info("Run 'pip3 install inotify-simple' to watch hot folders without polling")
+            return
+        try:
+            self.inotify = INotify()
+            self.inotify.add_watch(self.directory, inotify_flags.CREATE | inotify_flags.CLOSE_WRITE | inotify_flags.MOVED_TO)
+        except OSError as e:
+            logging.warning(f"Can't watch {self.directory} with inotify, polling instead: {e}")
+            self.inotify = None
+            return
+        asyncio.get_running_loop().add_reader(self.inotify.fileno(), self.inotify_ready)
+
+    def stop_watching(self):
+        if self.inotify is not None:
+            asyncio.get_running_loop().remove_reader(self.inotify.fileno())
+            self.inotify.close()
+            self.inotify = None
+
+    def inotify_ready(self):
+        self.inotify.read(timeout=0)
+        self.changed.set()
+
+    async def watch(self):
+        while True:
+            self.scan()
+            # poll while anything is settling; otherwise wait for an event
+            if self.candidates or self.inotify is None:
+                timeout = self.PollInterval
+            else:
+                timeout = self.RescanInterval
+            try:
+                await asyncio.wait_for(self.changed.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            self.changed.clear()
+
+    # (size, mtime) of each print file in the directory
+    def scan_directory(self):
+        files = {}
+        try:
+            entries = list(os.scandir(self.directory))
+        except OSError as e:
+            logging.error(f"Can't read {self.directory}: {e}")
+            return files
+        for entry in entries:
+            # skip hidden and temporary files, e.g. partial copies
+            if entry.name.startswith('.') or not entry.name.lower().endswith(self.Extensions):
+                continue
+            try:
+                if not entry.is_file():
+                    continue
+                st = entry.stat()
+            except OSError:
+                continue
+            files[entry.path] = (st.st_size, st.st_mtime_ns)
+        return files
+
+    def scan(self):
+        now = time.monotonic()
+        files = self.scan_directory()
+        for path in list(self.candidates):
+            if path not in files:
+                del self.candidates[path]
+        for path in list(self.handled):
+            if path not in files:
+                del self.handled[path]
+
+        for path, key in files.items():
+            if self.handled.get(path) == key:
+                continue
+            last = self.candidates.get(path)
+            if last is None or last[0] != key:
+                self.candidates[path] = (key, now)
+            elif key[0] > 0 and now - last[1] >= self.stable_time:
+                del self.candidates[path]
+                self.handled[path] = key
+                self.spawn(self.ingest(path, key))
+
+    def spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def ingest(self, path, key):
+        loop = asyncio.get_running_loop()
+        try:
+            fileinfo = await loop.run_in_executor(self.executor, fingerprint_file, path)
+            st = os.stat(path)
+        except OSError as e:
+            logging.error(f"Can't read {path}: {e}")
+            return
+
+        if (st.st_size, st.st_mtime_ns) != key or fileinfo['size'] != key[0]:
+            # written to while we were reading it; wait for it to settle again
+            logging.debug(f"{path} changed while hashing")
+            self.handled.pop(path, None)
+            return
+
+        md5 = fileinfo['md5']
+        if md5 in self.fingerprints:
+            logging.info(f"Skipping {os.path.basename(path)}: same contents as {os.path.basename(self.fingerprints[md5])}")
+            self.duplicates += 1
+            return
+        self.fingerprints[md5] = path
+        logging.info(f"Queued {os.path.basename(path)} ({fileinfo['size']} bytes, MD5 {md5})")
+        await self.queue.put((path, fileinfo, 0))
+
+    # Make a printer available for uploads again, once it isn't busy
+    def release(self, printer):
+        if printer.busy:
+            self.spawn(self.release_when_ready(printer))
+        else:
+            self.idle.put_nowait(printer)
+
+    async def release_when_ready(self, printer):
+        logging.info(f"{printer.describe()} is busy, will send it files once it's done")
+        queue = printer.subscribe_status()
+        try:
+            while printer.busy:
+                await queue.get()
+        except EOFError:
+            logging.error(f"Lost {printer.describe()}, not sending it any more files")
+            return
+        finally:
+            printer.unsubscribe_status(queue)
+        self.idle.put_nowait(printer)
+
+    async def dispatch(self):
+        while True:
+            path, fileinfo, attempt = await self.queue.get()
+            printer = await self.idle.get()
+            try:
+                ok = await self.upload(printer, path, fileinfo)
+            finally:
+                self.release(printer)
+
+            if ok:
+                self.uploaded += 1
+            elif attempt < self.Retries and os.path.exists(path):
+                logging.info(f"Retrying {os.path.basename(path)}")
+                await self.queue.put((path, fileinfo, attempt + 1))
+            else:
+                logging.error(f"Giving up on {os.path.basename(path)}")
+                self.failed += 1
+                # let it be tried again if it's dropped in again
+                self.fingerprints.pop(fileinfo['md5'], None)
+
+    async def upload(self, printer, path, fileinfo):
+        name = os.path.basename(path)
+        logging.info(f"Uploading {name} to {printer.describe()} ({printer.addr[0]})")
+        start = time.monotonic()
+        progress = None
+        try:
+            async for progress in printer.upload(path, fileinfo=fileinfo):
+                pass
+        except Exception as ex:
+            logging.error(f"Exception uploading {name} to {printer.describe()}: {ex}")
+            return False
+        if progress is None or progress[0] < 0:
+            logging.error(f"Upload of {name} to {printer.describe()} failed")
+            return False
+
+        elapsed = time.monotonic() - start
+        logging.info(f"Uploaded {name} to {printer.describe()} in {elapsed:.1f}s ({fileinfo['size'] / elapsed / 1e6:.2f} MB/s)")
+        if printer.http.tuning is not None:
+            printer.http.tuning.save()
+        return True
+
+    def stats(self):
+        return {
+            'uploaded': self.uploaded,
+            'failed': self.failed,
+            'duplicates': self.duplicates,
+            'queued': self.queue.qsize(),
+            'settling': len(self.candidates),
+        }
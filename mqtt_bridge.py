@@ -0,0 +1,130 @@
+#
+# Cassini
+#
+# Copyright (C) 2023 Vladimir Vukicevic
+# License: MIT
+#
+
+import logging
+import asyncio
+import json
+import time
+
+# Republishes printer status from our SimpleMQTTServer to an upstream broker.
+#
+# Each printer's /sdcp/status payload is flattened into individual fields
+# (e.g. "PrintInfo/CurrentLayer"), and only fields whose value changed are
+# sent, as retained messages on <prefix>/<MainboardID>/status/<field>. Each
+# upstream topic is published at most once every min_interval seconds; a value
+# that changes faster than that is coalesced and only its latest value is sent.
+# Everything that is due is written out together every flush_interval seconds.
+class MQTTBridge:
+    def __init__(self, mqtt, upstream, prefix="cassini", min_interval=5.0, flush_interval=0.5):
+        self.mqtt = mqtt
+        self.upstream = upstream
+        self.prefix = prefix.rstrip('/')
+        self.min_interval = min_interval
+        self.flush_interval = flush_interval
+
+        # last status fields received, per printer
+        self.state = {}
+        # upstream topic -> value waiting to be published
+        self.pending = {}
+        # upstream topic -> (value, time) last published
+        self.published = {}
+
+        self.received_count = 0
+        self.published_count = 0
+        self.flush_count = 0
+
+    def start(self):
+        self.mqtt.add_publish_listener(self.incoming_publish)
+
+    def stop(self):
+        self.mqtt.remove_publish_listener(self.incoming_publish)
+
+    def incoming_publish(self, client_id, topic, payload):
+        if not topic.startswith("/sdcp/status/"):
+            return
+        self.received_count += 1
+
+        printer_id = topic[len("/sdcp/status/"):]
+        data = json.loads(payload)
+        fields = self.normalize_status(data['Data']['Status'])
+
+        last = self.state.get(printer_id, {})
+        for field, value in fields.items():
+            if last.get(field) != value:
+                self.pending[f"{self.prefix}/{printer_id}/status/{field}"] = value
+        self.state[printer_id] = fields
+
+    # Flatten the nested status dict into "A/B/C" -> leaf value
+    def normalize_status(self, status, path=""):
+        fields = {}
+        for key, value in status.items():
+            if isinstance(value, dict):
+                fields.update(self.normalize_status(value, path + key + "/"))
+            else:
+                fields[path + key] = value
+        return fields
+
+    # Publish everything that's due; returns the number of messages sent.
+    # While the upstream connection is down, changes just accumulate.
+    async def flush(self, now=None):
+        if not self.upstream.connected:
+            return 0
+        if now is None:
+            now = time.monotonic()
+
+        due = []
+        for topic, value in self.pending.items():
+            last = self.published.get(topic)
+            if last is not None and last[0] == value:
+                # changed and changed back before we got to send it
+                due.append(topic)
+                continue
+            if last is not None and now - last[1] < self.min_interval:
+                continue
+            self.upstream.publish(topic, json.dumps(value), retain=True)
+            self.published[topic] = (value, now)
+            self.published_count += 1
+            due.append(topic)
+
+        for topic in due:
+            del self.pending[topic]
+
+        try:
+            count = await self.upstream.flush()
+        except ConnectionError as e:
+            # whoever is watching upstream.closed reconnects and republishes
+            logging.warning(f"Bridge: upstream write failed: {e}")
+            self.upstream.close()
+            return 0
+        if count:
+            self.flush_count += 1
+        return count
+
+    # Publish the last value of every topic again, after reconnecting to the
+    # upstream broker; anything sent just before the connection dropped may
+    # not have made it
+    def republish(self):
+        for topic, (value, when) in self.published.items():
+            self.upstream.publish(topic, json.dumps(value), retain=True)
+
+    async def run(self):
+        self.start()
+        try:
+            while True:
+                await asyncio.sleep(self.flush_interval)
+                await self.flush()
+        finally:
+            self.stop()
+
+    def stats(self):
+        ratio = self.received_count / self.published_count if self.published_count else None
+        return {
+            'received': self.received_count,
+            'published': self.published_count,
+            'writes': self.flush_count,
+            'ratio': ratio
+        }
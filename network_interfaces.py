@@ -0,0 +1,98 @@
+#
+# Cassini
+#
+# Copyright (C) 2023 Vladimir Vukicevic
+# License: MIT
+#
+
+import sys
+import socket
+import struct
+import logging
+import ipaddress
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# from linux/sockios.h and linux/if.h
+SIOCGIFFLAGS = 0x8913
+SIOCGIFADDR = 0x8915
+SIOCGIFBRDADDR = 0x8919
+SIOCGIFNETMASK = 0x891b
+IFF_UP = 0x1
+IFF_BROADCAST = 0x2
+IFF_LOOPBACK = 0x8
+
+# The IPv4 interfaces that are up, as a list of dicts of name, address,
+# netmask and broadcast (None where the interface has no broadcast address,
+# e.g. loopback). Uses psutil if it's installed, otherwise asks the kernel
+# directly on Linux (which only sees each interface's primary address).
+# Returns an empty list if neither works.
+def local_interfaces():
+    if psutil is not None:
+        return psutil_interfaces()
+    if fcntl is not None and sys.platform.startswith('linux'):
+        return ioctl_interfaces()
+    logging.info("Run 'pip3 install psutil' to discover printers on every network interface")
+    return []
+
+def psutil_interfaces():
+    interfaces = []
+    stats = psutil.net_if_stats()
+    for name, addrs in psutil.net_if_addrs().items():
+        if name in stats and not stats[name].isup:
+            continue
+        for addr in addrs:
+            if addr.family != socket.AF_INET or not addr.netmask:
+                continue
+            broadcast = addr.broadcast
+            # not filled in on every platform
+            if broadcast is None and not ipaddress.ip_address(addr.address).is_loopback:
+                broadcast = subnet_broadcast(addr.address, addr.netmask)
+            interfaces.append({ 'name': name, 'address': addr.address, 'netmask': addr.netmask, 'broadcast': broadcast })
+    return interfaces
+
+def ioctl_interfaces():
+    interfaces = []
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    with sock:
+        for index, name in socket.if_nameindex():
+            ifreq = struct.pack('256s', name.encode()[:15])
+            try:
+                flags = struct.unpack('H', fcntl.ioctl(sock.fileno(), SIOCGIFFLAGS, ifreq)[16:18])[0]
+                if not flags & IFF_UP:
+                    continue
+                address = socket.inet_ntoa(fcntl.ioctl(sock.fileno(), SIOCGIFADDR, ifreq)[20:24])
+                netmask = socket.inet_ntoa(fcntl.ioctl(sock.fileno(), SIOCGIFNETMASK, ifreq)[20:24])
+                broadcast = None
+                if flags & IFF_BROADCAST and not flags & IFF_LOOPBACK:
+                    broadcast = socket.inet_ntoa(fcntl.ioctl(sock.fileno(), SIOCGIFBRDADDR, ifreq)[20:24])
+            except OSError:
+                # no IPv4 address
+                continue
+            interfaces.append({ 'name': name, 'address': address, 'netmask': netmask, 'broadcast': broadcast })
+    return interfaces
+
+def subnet_broadcast(address, netmask):
+    network = ipaddress.IPv4Network(f"{address}/{netmask}", strict=False)
+    if network.prefixlen >= 31:
+        return None
+    return str(network.broadcast_address)
+
+# (local address, broadcast address) for each interface that can broadcast,
+# or just the limited broadcast address if we can't tell
+def broadcast_targets():
+    targets = []
+    for iface in local_interfaces():
+        if iface['broadcast'] is not None and (iface['address'], iface['broadcast']) not in targets:
+            targets.append((iface['address'], iface['broadcast']))
+    if not targets:
+        targets.append(('0.0.0.0', '<broadcast>'))
+    return targets
@@ -0,0 +1,321 @@
+#!env python3
+# -*- coding: utf-8 -*-
+#
+# Cassini
+#
+# Copyright (C) 2023 Vladimir Vukicevic
+# License: MIT
+#
+# A simulated printer, speaking the same UDP, MQTT and HTTP protocol as a
+# real one, for exercising cassini without hardware. Several can be run at
+# once on different loopback addresses (127.0.0.2, 127.0.0.3, ...), e.g.:
+#
+#   ./printer_simulator.py --count 4 --host 127.0.0.2
+#   ./cassini.py --sweep 127.0.0.0/29 status
+#
+import json
+import time
+import random
+import asyncio
+import hashlib
+import logging
+import argparse
+from urllib.parse import urlparse
+
+from simple_mqtt_client import SimpleMQTTClient
+
+SATURN_UDP_PORT = 3000
+
+class SimulatedPrinterProtocol(asyncio.DatagramProtocol):
+    def __init__(self, printer):
+        self.printer = printer
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.printer.incoming_udp(self.transport, data, addr)
+
+class SimulatedPrinter:
+    def __init__(self, host="127.0.0.1", port=SATURN_UDP_PORT, mainboard_id=None, name="SimSaturn",
+                 total_layers=50, layer_time=2.0, download_rate=None):
+        self.host = host
+        self.port = port
+        self.id = mainboard_id or '%016x' % random.getrandbits(64)
+        self.name = name
+        self.total_layers = total_layers
+        self.layer_time = layer_time
+        # bytes/second to throttle downloads to, to simulate a weak link
+        self.download_rate = download_rate
+
+        self.transport = None
+        self.mqtt = None
+        self.mqtt_host = None
+        self.status_task = None
+        self.job_task = None
+        self.time_period = 5000
+        # set to publish a status right away, instead of at the next period
+        self.status_changed = asyncio.Event()
+
+        self.current_status = 0
+        self.previous_status = 0
+        self.print_info = {
+            "Status": 0, "CurrentLayer": 0, "TotalLayer": 0,
+            "CurrentTicks": 0, "TotalTicks": 0, "ErrorNumber": 0, "Filename": ""
+        }
+        self.file_transfer_info = {
+            "Status": 0, "DownloadOffset": 0, "CheckOffset": 0, "FileTotalSize": 0, "Filename": ""
+        }
+        self.files = {}
+
+        self.started = time.monotonic()
+        self.status_count = 0
+        self.response_count = 0
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        self.transport, _ = await loop.create_datagram_endpoint(
+            lambda: SimulatedPrinterProtocol(self), local_addr=(self.host, self.port))
+        # in case port 0 was asked for
+        self.port = self.transport.get_extra_info('sockname')[1]
+        logging.info(f"Simulated printer {self.id} listening on {self.host}:{self.port}")
+
+    def stop(self):
+        for task in (self.status_task, self.job_task):
+            if task is not None:
+                task.cancel()
+        if self.mqtt is not None:
+            self.mqtt.close()
+        if self.transport is not None:
+            self.transport.close()
+
+    def stats(self):
+        elapsed = time.monotonic() - self.started
+        return {
+            'status_messages': self.status_count,
+            'responses': self.response_count,
+            'elapsed': elapsed,
+            'status_rate': self.status_count / elapsed if elapsed > 0 else 0
+        }
+
+    def status(self):
+        return {
+            "CurrentStatus": self.current_status,
+            "PreviousStatus": self.previous_status,
+            "PrintInfo": dict(self.print_info),
+            "FileTransferInfo": dict(self.file_transfer_info)
+        }
+
+    def desc(self):
+        return {
+            "Id": self.id + "0" * 16,
+            "Data": {
+                "Attributes": {
+                    "Name": self.name,
+                    "MachineName": "Simulated " + self.name,
+                    "ProtocolVersion": "V1.0.0",
+                    "FirmwareVersion": "V0.0.0",
+                    "Resolution": "11520x5120",
+                    "MainboardIP": self.host,
+                    "MainboardID": self.id,
+                    "SDCPStatus": 1 if self.mqtt is not None else 0,
+                    "LocalSDCPAddress": "",
+                    "SDCPAddress": "",
+                    "Capabilities": ["FILE_TRANSFER", "PRINT_CONTROL"]
+                },
+                "Status": self.status()
+            }
+        }
+
+    def set_current_status(self, status):
+        self.previous_status = self.current_status
+        self.current_status = status
+        self.status_changed.set()
+
+    def incoming_udp(self, transport, data, addr):
+        if data == b'M99999':
+            transport.sendto(json.dumps(self.desc()).encode('utf-8'), addr)
+        elif data.startswith(b'M66666 '):
+            port = int(data[7:])
+            asyncio.ensure_future(self.connect_mqtt(addr[0], port))
+        else:
+            logging.debug(f"Simulated printer {self.id}: unknown UDP message {data}")
+
+    async def connect_mqtt(self, host, port):
+        if self.mqtt is not None:
+            self.mqtt.close()
+        if self.status_task is not None:
+            self.status_task.cancel()
+
+        self.mqtt_host = host
+        self.mqtt = SimpleMQTTClient(host, port, self.id, qos0_packet_ids=True, local_addr=(self.host, 0))
+        self.mqtt.on_message = self.incoming_request
+        try:
+            await self.mqtt.connect()
+            await self.mqtt.subscribe("/sdcp/request/" + self.id)
+        except (OSError, ConnectionError) as e:
+            logging.error(f"Simulated printer {self.id}: MQTT connection to {host}:{port} failed: {e}")
+            self.mqtt = None
+            return
+        self.status_task = asyncio.create_task(self.status_loop())
+
+    async def status_loop(self):
+        try:
+            while self.mqtt.connected:
+                self.publish("/sdcp/status/" + self.id, { "Status": self.status() })
+                self.status_count += 1
+                await self.mqtt.flush()
+                try:
+                    await asyncio.wait_for(self.status_changed.wait(), self.time_period / 1000)
+                    self.status_changed.clear()
+                except asyncio.TimeoutError:
+                    pass
+        except ConnectionError:
+            pass
+
+    def publish(self, topic, data):
+        payload = {
+            "Id": self.id + "0" * 16,
+            "Data": dict(data, MainboardID=self.id, TimeStamp=int((time.monotonic() - self.started) * 1000))
+        }
+        # the printers publish with QoS 1
+        self.mqtt.publish(topic, json.dumps(payload), qos=1)
+
+    def incoming_request(self, topic, payload):
+        request = json.loads(payload)['Data']
+        cmd = request['Cmd']
+        data = request['Data']
+        ack = 0
+
+        if cmd == 128:
+            if self.job_task is not None and not self.job_task.done():
+                ack = 1
+            else:
+                self.job_task = asyncio.create_task(self.run_print(data['Filename']))
+        elif cmd == 256:
+            if self.job_task is not None and not self.job_task.done():
+                ack = 1
+            else:
+                self.job_task = asyncio.create_task(self.run_download(data))
+        elif cmd == 512:
+            self.time_period = data['TimePeriod']
+            self.status_changed.set()
+        elif cmd not in (0, 1, 64):
+            logging.warning(f"Simulated printer {self.id}: unknown command {cmd}")
+
+        self.publish("/sdcp/response/" + self.id, {
+            "Cmd": cmd,
+            "Data": { "Ack": ack },
+            "RequestID": request['RequestID']
+        })
+        self.response_count += 1
+        asyncio.ensure_future(self.mqtt.flush())
+
+    async def run_download(self, data):
+        info = self.file_transfer_info
+        info.update(Status=0, DownloadOffset=0, CheckOffset=0, FileTotalSize=data['FileSize'], Filename=data['Filename'])
+        self.set_current_status(1)
+
+        url = urlparse(data['URL'].replace('${ipaddr}', self.mqtt_host))
+        md5 = hashlib.md5()
+        ok = False
+        try:
+            reader, writer = await asyncio.open_connection(url.hostname, url.port, local_addr=(self.host, 0))
+            # the printer probes the file before fetching it
+            request = f"HEAD {url.path} HTTP/1.1\r\nHost: {url.netloc}\r\n\r\n"
+            request += f"GET {url.path} HTTP/1.1\r\nHost: {url.netloc}\r\nConnection: close\r\n\r\n"
+            writer.write(request.encode())
+            await writer.drain()
+            await reader.readuntil(b'\r\n\r\n')
+            head = (await reader.readuntil(b'\r\n\r\n')).decode('latin-1')
+            if not head.startswith("HTTP/1.1 200"):
+                raise ConnectionError(head.splitlines()[0])
+
+            chunk_start = time.monotonic()
+            while info['DownloadOffset'] < data['FileSize']:
+                chunk = await reader.read(65536)
+                if not chunk:
+                    break
+                md5.update(chunk)
+                info['DownloadOffset'] += len(chunk)
+                if self.download_rate:
+                    # sleep off whatever time this chunk should have taken
+                    due = chunk_start + info['DownloadOffset'] / self.download_rate
+                    delay = due - time.monotonic()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+            writer.close()
+            ok = info['DownloadOffset'] == data['FileSize'] and md5.hexdigest() == data['MD5']
+        except (OSError, ConnectionError, asyncio.IncompleteReadError) as e:
+            logging.error(f"Simulated printer {self.id}: download failed: {e}")
+
+        if ok:
+            self.files[data['Filename']] = data['FileSize']
+        info['CheckOffset'] = info['DownloadOffset']
+        info['Status'] = 2 if ok else 3
+        self.set_current_status(0)
+
+    async def run_print(self, filename):
+        info = self.print_info
+        total_ticks = int(self.total_layers * self.layer_time * 1000)
+        info.update(Status=2, CurrentLayer=0, TotalLayer=self.total_layers, CurrentTicks=0,
+                    TotalTicks=total_ticks, ErrorNumber=0, Filename=filename)
+        self.set_current_status(1)
+        start = time.monotonic()
+        for layer in range(1, self.total_layers + 1):
+            await asyncio.sleep(self.layer_time)
+            info['CurrentLayer'] = layer
+            info['CurrentTicks'] = int((time.monotonic() - start) * 1000)
+        info['Status'] = 16
+        self.set_current_status(0)
+
+async def run_simulators(args):
+    base = [int(x) for x in args.host.split('.')]
+    printers = []
+    for i in range(args.count):
+        host = '.'.join(str(x) for x in base[:3] + [base[3] + i])
+        printer = SimulatedPrinter(host, args.port, total_layers=args.layers, layer_time=args.layer_time,
+                                   download_rate=args.download_rate)
+        await printer.start()
+        printers.append(printer)
+
+    try:
+        while True:
+            await asyncio.sleep(args.report_interval)
+            for p in printers:
+                stats = p.stats()
+                logging.info(f"{p.host} {p.id}: period {p.time_period} ms, {stats['status_messages']} status messages ({stats['status_rate']:.2f}/s)")
+            total = sum(p.stats()['status_rate'] for p in printers)
+            logging.info(f"Total status rate: {total:.2f}/s")
+    finally:
+        for p in printers:
+            p.stop()
+
+def main():
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s,%(msecs)d %(levelname)s: %(message)s",
+        datefmt="%H:%M:%S",
+    )
+
+    parser = argparse.ArgumentParser(prog='printer_simulator', description='Simulated ELEGOO Saturn printers')
+    parser.add_argument('--host', help='Address of the first simulated printer', default='127.0.0.2')
+    parser.add_argument('--port', type=int, help='UDP port to listen on', default=SATURN_UDP_PORT)
+    parser.add_argument('--count', type=int, help='Number of printers, on consecutive addresses', default=1)
+    parser.add_argument('--layers', type=int, help='Layers in a simulated print', default=50)
+    parser.add_argument('--layer-time', type=float, help='Seconds per simulated layer', default=2.0)
+    parser.add_argument('--download-rate', type=float, help='Throttle file downloads to this many bytes/second')
+    parser.add_argument('--report-interval', type=float, help='Seconds between status rate reports', default=30)
+    parser.add_argument('--debug', help='Enable debug logging', action='store_true')
+    args = parser.parse_args()
+
+    if args.debug:
+        logging.getLogger().setLevel(logging.DEBUG)
+
+    try:
+        asyncio.run(run_simulators(args))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
@@ -20,6 +20,9 @@ logging.getLogger("scapy.runtime").setLevel(logging.ERROR)
 
 from scapy.all import IP, UDP, send
 
+import session_recorder
+from session_recorder import DIR_IN, REC_UDP
+
 SATURN_UDP_PORT = 3000
 
 # CurrentStatus field inside Status
@@ -53,62 +56,98 @@ class Command(Enum):
 def random_hexstr():
     return '%032x' % random.getrandbits(128)
 
+# A single-slot queue that only keeps the most recent value: put() never
+# blocks or grows, and get() returns whatever is newest since the last get().
+class LatestValueQueue:
+    def __init__(self):
+        self.value = None
+        self.has_value = False
+        self.closed = False
+        self.event = asyncio.Event()
+
+    def put(self, value):
+        self.value = value
+        self.has_value = True
+        self.event.set()
+
+    def close(self):
+        self.closed = True
+        self.event.set()
+
+    async def get(self):
+        await self.event.wait()
+        if not self.has_value:
+            raise EOFError("queue closed")
+        value = self.value
+        self.value = None
+        self.has_value = False
+        if not self.closed:
+            self.event.clear()
+        return value
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return await self.get()
+        except EOFError:
+            raise StopAsyncIteration
+
 class SaturnPrinter:
     def __init__(self, addr, desc, timeout=5):
         self.addr = addr
         self.timeout = timeout
-        self.file_transfer_future = None
+        self.mqtt = None
+        self.listening = False
+        self.status_subscribers = set()
+        self.pending_requests = {}
+        # a StatusPeriodPolicy to adapt the status period with, if any
+        self.period_policy = None
+        # status period changes in flight
+        self.tasks = set()
         if desc is not None:
             self.set_desc(desc)
         else:
             self.desc = None
 
-    # Broadcast and find all printers, return array of SaturnPrinter objects
+    # Find printers by broadcasting, on every interface or to the given
+    # broadcast address. Not for use inside an event loop; there, await
+    # Discovery().discover() instead.
+    @staticmethod
     def find_printers(timeout=1, broadcast=None):
-        if broadcast is None:
-            broadcast = '<broadcast>'
-        printers = []
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        with sock:
-            sock.settimeout(timeout)
-            sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, timeout)
-            sock.sendto(b'M99999', (broadcast, SATURN_UDP_PORT))
-
-            now = time.time()
-            while True:
-                if time.time() - now > timeout:
-                    break
-                try:
-                    data, addr = sock.recvfrom(1024)
-                except socket.timeout:
-                    continue
-                else:
-                    #logging.debug(f'Found printer at {addr}')
-                    pdata = json.loads(data.decode('utf-8'))
-                    printers.append(SaturnPrinter(addr, pdata))
-        return printers
+        from discovery import Discovery
+        targets = [('0.0.0.0', broadcast)] if broadcast is not None else None
+        return asyncio.run(Discovery(timeout=timeout).discover(targets))
 
     # Find a specific printer at the given address, return a SaturnPrinter object
-    # or None if no response is obtained 
+    # or None if no response is obtained. Not for use inside an event loop;
+    # there, use StatusPoller.find_printers() instead.
+    @staticmethod
     def find_printer(addr, timeout=5):
-        printers = SaturnPrinter.find_printers(broadcast=addr)
-        if len(printers) == 0 or printers[0].addr[0] != addr:
-            return None
-        return printers[0]
-
-    # Refresh this SaturnPrinter with latest status 
+        from status_poller import StatusPoller
+        async def find():
+            async with StatusPoller(timeout=timeout) as poller:
+                return await poller.find_printers([addr])
+        printers = asyncio.run(find())
+        return printers[0] if printers else None
+
+    # Refresh this SaturnPrinter with latest status. To refresh many at once,
+    # use StatusPoller instead.
     def refresh(self, timeout=5):
         sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         with sock:
             sock.settimeout(timeout)
-            sock.sendto(b'M99999', (self.addr, SATURN_UDP_PORT))
+            sock.sendto(b'M99999', (self.addr[0], SATURN_UDP_PORT))
             try:
                 data, addr = sock.recvfrom(1024)
             except socket.timeout:
                 return False
             else:
+                session_recorder.record(REC_UDP, DIR_IN, addr, data)
                 pdata = json.loads(data.decode('utf-8'))
                 self.set_desc(pdata)
+                return True
 
     def set_desc(self, desc):
         self.desc = desc
@@ -124,10 +163,25 @@ class SaturnPrinter:
         self.mqtt = mqtt
         self.http = http
 
+        # If this printer already went through the handshake with this server,
+        # its session (subscriptions, pending messages) is still there. Just make
+        # sure it's connected and pick the existing state back up.
+        attached = mqtt.attached_printer(self.id)
+        if attached is not None:
+            if attached is not self:
+                self.adopt(attached)
+            self.listen()
+            if not mqtt.is_connected(self.id):
+                self.send_mqtt_connect(mqtt)
+                await asyncio.wait_for(mqtt.wait_for_client(self.id), timeout=self.timeout)
+            logging.debug(f"Re-attached to existing MQTT session for {self.id}")
+            mqtt.attach_printer(self.id, self)
+            return True
+
+        self.listen()
+
         # Tell the printer to connect
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        with sock:
-            sock.sendto(b'M66666 ' + str(mqtt.port).encode('utf-8'), self.addr)
+        self.send_mqtt_connect(mqtt)
 
         # wait for the connection
         client_id = await asyncio.wait_for(mqtt.client_connection, timeout=self.timeout)
@@ -141,25 +195,108 @@ class SaturnPrinter:
 
         await self.send_command_and_wait(Command.CMD_0)
         await self.send_command_and_wait(Command.CMD_1)
-        await self.send_command_and_wait(Command.SET_MYSTERY_TIME_PERIOD, { 'TimePeriod': 5000 })
+        period = 5000
+        if self.period_policy is not None:
+            period = self.period_policy.register(self)
+        await self.send_command_and_wait(Command.SET_MYSTERY_TIME_PERIOD, { 'TimePeriod': period })
+        mqtt.set_status_period(self.id, period)
 
+        mqtt.attach_printer(self.id, self)
         return True
 
-    async def disconnect(self):
-        await self.send_command_and_wait(Command.DISCONNECT)
-
-    async def upload_file(self, filename, start_printing=False):
-        try:
-            await self.upload_file_inner(filename, start_printing)
-        except Exception as ex:
-            logging.error(f"Exception during upload: {ex}")
-            self.file_transfer_future.set_result((-1, -1, filename))
-            self.file_transfer_future = asyncio.get_running_loop().create_future()
+    def send_mqtt_connect(self, mqtt):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        with sock:
+            sock.sendto(b'M66666 ' + str(mqtt.port).encode('utf-8'), self.addr)
 
-    async def upload_file_inner(self, filename, start_printing=False):
-        # schedule a future that can be used for status, in case this is kicked off as a task
-        self.file_transfer_future = asyncio.get_running_loop().create_future()
+    # Start receiving this printer's messages from the mqtt server
+    def listen(self):
+        if not self.listening:
+            self.mqtt.add_publish_listener(self.incoming_publish)
+            self.listening = True
+
+    def unlisten(self):
+        if self.listening:
+            self.mqtt.remove_publish_listener(self.incoming_publish)
+            self.listening = False
+
+    # Take over the state of another SaturnPrinter for the same printer, keeping
+    # our (newer) discovery data
+    def adopt(self, other):
+        other.unlisten()
+        self.status_subscribers |= other.status_subscribers
+        self.pending_requests.update(other.pending_requests)
+        other.status_subscribers = set()
+        other.pending_requests = {}
+        if self.period_policy is None:
+            self.period_policy = other.period_policy
+        if self.period_policy is not None:
+            self.period_policy.register(self)
 
+    async def disconnect(self):
+        try:
+            await self.send_command_and_wait(Command.DISCONNECT)
+        finally:
+            if self.period_policy is not None:
+                self.period_policy.unregister(self)
+
+    # Called by the mqtt server when it drops this printer's session. No more
+    # status will arrive, so end every statuses() and subscriber queue.
+    def session_dropped(self):
+        if self.period_policy is not None:
+            self.period_policy.unregister(self)
+        for queue in self.status_subscribers:
+            queue.close()
+        self.status_subscribers = set()
+
+    # Change how often the printer publishes status (in ms). Doesn't wait for
+    # the response; this is called by the period policy as printers change state.
+    def set_status_period(self, period):
+        if self.mqtt is None or not self.mqtt.is_connected(self.id):
+            return
+        logging.debug(f"Setting status period of {self.id} to {period} ms")
+        task = asyncio.ensure_future(self.send_status_period(period))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def send_status_period(self, period):
+        try:
+            result = await self.send_command_and_wait(Command.SET_MYSTERY_TIME_PERIOD, { 'TimePeriod': period }, abort_on_bad_ack=False)
+        except (asyncio.TimeoutError, ConnectionError):
+            logging.warning(f"No response setting status period of {self.id}")
+            return
+        if result['Ack'] != 0:
+            logging.warning(f"Bad ack setting status period of {self.id}: {result}")
+            return
+        self.mqtt.set_status_period(self.id, period)
+
+    # Subscribe to status updates from this printer. Only the latest status is
+    # kept for each subscriber, so one that falls behind skips intermediate
+    # updates rather than queueing them. The printer must be connect()ed.
+    # Ends if the printer's MQTT session is dropped.
+    async def statuses(self):
+        queue = self.subscribe_status()
+        try:
+            async for status in queue:
+                yield status
+        finally:
+            self.unsubscribe_status(queue)
+
+    def subscribe_status(self):
+        queue = LatestValueQueue()
+        self.status_subscribers.add(queue)
+        return queue
+
+    def unsubscribe_status(self, queue):
+        self.status_subscribers.discard(queue)
+        queue.close()
+
+    # Upload a file, yielding (offset, total size, filename) progress tuples as
+    # the printer reports them. On failure the last tuple has an offset of -1.
+    # fileinfo is the file's fingerprint_file(), if already known. With
+    # abort_on_bad_ack set, a printer refusing the upload exits the program
+    # instead.
+    async def upload(self, filename, start_printing=False, fileinfo=None, abort_on_bad_ack=False):
         # get base filename and extension
         basename = filename.split('\\')[-1].split('/')[-1]
         ext = basename.split('.')[-1].lower()
@@ -167,7 +304,9 @@ class SaturnPrinter:
             logging.warning(f"Unknown file extension: {ext}")
 
         httpname = random_hexstr() + '.' + ext 
-        fileinfo = self.http.register_file_route('/' + httpname, filename)
+        if self.http.tuning is not None:
+            self.http.tuning.set_client_id(self.addr[0], self.id)
+        fileinfo = self.http.register_file_route('/' + httpname, filename, fileinfo)
 
         cmd_data = {
             "Check": 0,
@@ -179,68 +318,84 @@ class SaturnPrinter:
             "URL": f"http://${{ipaddr}}:{self.http.port}/{httpname}"
         }
 
-        await self.send_command_and_wait(Command.UPLOAD_FILE, cmd_data)
-
-        # now process status updates from the printer
-        while True:
-            reply = await asyncio.wait_for(self.mqtt.next_published_message(), timeout=self.timeout*2)
-            data = json.loads(reply['payload'])
-            if reply['topic'] == "/sdcp/response/" + self.id:
-                logging.warning(f"Got unexpected RESPONSE (no outstanding request), topic: {reply['topic']} data: {data}")
-            elif reply['topic'] == "/sdcp/status/" + self.id:
-                self.incoming_status(data['Data']['Status'])
+        before = dict(self.desc['Data']['Status']['FileTransferInfo']) if self.desc is not None else None
 
-                status = data['Data']['Status']
+        # subscribe before sending, so no status update can be missed
+        queue = self.subscribe_status()
+        try:
+            if self.period_policy is not None:
+                self.period_policy.transfer_starting(self)
+            result = await self.send_command_and_wait(Command.UPLOAD_FILE, cmd_data, abort_on_bad_ack)
+            if result['Ack'] != 0:
+                logging.error(f"Printer refused upload: {result}")
+                yield (-1, fileinfo['size'], basename)
+                return
+
+            # now process status updates from the printer
+            started = False
+            start_deadline = asyncio.get_running_loop().time() + self.timeout*2
+            while True:
+                try:
+                    status = await asyncio.wait_for(queue.get(), timeout=self.timeout*2)
+                except EOFError:
+                    raise ConnectionError(f"Printer {self.id} session dropped")
                 file_info = status['FileTransferInfo']
                 current_offset = file_info['DownloadOffset']
                 total_size = file_info['FileTotalSize']
                 file_name = file_info['Filename']
 
-                # We assume that the printer immediately goes into BUSY status after it processes
-                # the upload command
-                if status['CurrentStatus'] == CurrentStatus.READY:
-                    if file_info['Status'] == FileStatus.DONE:
-                        self.file_transfer_future.set_result((total_size, total_size, file_name))
-                    elif file_info['Status'] == FileStatus.ERROR:
+                # The printer goes into BUSY status once it processes the upload command,
+                # and back to READY with the transfer result when it's done. A short
+                # transfer can fall entirely between two status updates, so also take a
+                # result for this file that wasn't there before we sent the command. A
+                # result that's the same as before could be left over from an earlier
+                # upload of the same name, so that's never taken as this one's.
+                if status['CurrentStatus'] != CurrentStatus.READY.value:
+                    started = True
+                else:
+                    finished = file_info['Status'] in (FileStatus.DONE.value, FileStatus.ERROR.value) and file_name == basename
+                    if not started and not (finished and file_info != before):
+                        # hasn't picked up the command yet
+                        if asyncio.get_running_loop().time() > start_deadline:
+                            raise asyncio.TimeoutError("printer didn't start the transfer")
+                        continue
+
+                    if file_info['Status'] == FileStatus.DONE.value:
+                        yield (total_size, total_size, file_name)
+                    elif file_info['Status'] == FileStatus.ERROR.value:
                         logging.error("Transfer error!")
-                        self.file_transfer_future.set_result((-1, total_size, file_name))
+                        yield (-1, total_size, file_name)
                     else:
                         logging.error(f"Unknown file transfer status code: {file_info['Status']}")
-                        self.file_transfer_future.set_result((-1, total_size, file_name))
-                    break
-
-                self.file_transfer_future.set_result((current_offset, total_size, file_name))
-                self.file_transfer_future = asyncio.get_running_loop().create_future()
-            elif reply['topic'] == "/sdcp/attributes/" + self.id:
-                # ignore these
-                pass
-            else:
-                logging.warning(f"Got unknown topic message: {reply['topic']}")
+                        yield (-1, total_size, file_name)
+                    return
 
-        self.file_transfer_future = None
+                yield (current_offset, total_size, file_name)
+        finally:
+            self.unsubscribe_status(queue)
+            self.http.unregister_file_route('/' + httpname)
 
     async def send_command_and_wait(self, cmdid, data=None, abort_on_bad_ack=True):
-        # Send the 0 and 1 messages
-        req = self.send_command(cmdid, data)
+        future = asyncio.get_running_loop().create_future()
+        req, msg = self.send_command(cmdid, data)
+        if msg is None:
+            raise ConnectionError(f"Printer {self.id} is not connected")
+        self.pending_requests[req] = future
         logging.debug(f"Sent command {cmdid} as request {req}")
-        while True:
-            reply = await asyncio.wait_for(self.mqtt.next_published_message(), timeout=self.timeout)
-            data = json.loads(reply['payload'])
-            if reply['topic'] == "/sdcp/response/" + self.id:
-                if data['Data']['RequestID'] == req:
-                    logging.debug(f"Got response to {req}")
-                    result = data['Data']['Data']
-                    if abort_on_bad_ack and result['Ack'] != 0:
-                        logging.error(f"Got bad ack in response: {result}")
-                        sys.exit(1)
-                    return result
-            elif reply['topic'] == "/sdcp/status/" + self.id:
-                self.incoming_status(data['Data']['Status'])
-            elif reply['topic'] == "/sdcp/attributes/" + self.id:
-                # ignore these
-                pass
-            else:
-                logging.warning(f"Got unknown topic message: {reply['topic']}")
+        try:
+            result = await asyncio.wait_for(future, timeout=self.timeout)
+        except asyncio.TimeoutError:
+            # don't let the printer act on it later, after we've given up
+            self.mqtt.withdraw(msg)
+            raise
+        finally:
+            self.pending_requests.pop(req, None)
+
+        logging.debug(f"Got response to {req}")
+        if abort_on_bad_ack and result['Ack'] != 0:
+            logging.error(f"Got bad ack in response: {result}")
+            sys.exit(1)
+        return result
 
     async def print_file(self, filename):
         cmd_data = {
@@ -248,27 +403,28 @@ class SaturnPrinter:
             "StartLayer": 0
         }
 
-        await self.send_command_and_wait(Command.START_PRINTING, cmd_data)
-
-        # process status updates from the printer, enough to know whether printing
-        # started or failed to start
-        status_count = 0
-        while True:
-            reply = await asyncio.wait_for(self.mqtt.next_published_message(), timeout=self.timeout*2)
-            data = json.loads(reply['payload'])
-            if reply['topic'] == "/sdcp/response/" + self.id:
-                logging.warning(f"Got unexpected RESPONSE (no outstanding request), topic: {reply['topic']} data: {data}")
-            elif reply['topic'] == "/sdcp/status/" + self.id:
-                self.incoming_status(data['Data']['Status'])
+        queue = self.subscribe_status()
+        try:
+            if self.period_policy is not None:
+                self.period_policy.print_starting(self)
+            await self.send_command_and_wait(Command.START_PRINTING, cmd_data)
+
+            # process status updates from the printer, enough to know whether printing
+            # started or failed to start
+            status_count = 0
+            while True:
+                try:
+                    status = await asyncio.wait_for(queue.get(), timeout=self.timeout*2)
+                except EOFError:
+                    raise ConnectionError(f"Printer {self.id} session dropped")
                 status_count += 1
 
-                status = data['Data']['Status']
                 print_info = status['PrintInfo']
 
                 current_status = status['CurrentStatus']
                 print_status = print_info['Status']
 
-                if current_status == CurrentStatus.BUSY and print_status > 0:
+                if current_status == CurrentStatus.BUSY.value and print_status > 0:
                     return True
 
                 logging.debug(status)
@@ -277,23 +433,43 @@ class SaturnPrinter:
                 if status_count >= 5:
                     logging.warning("Too many status replies without success or failure")
                     return False
+        finally:
+            self.unsubscribe_status(queue)
 
-            elif reply['topic'] == "/sdcp/attributes/" + self.id:
-                # ignore these
-                pass
-            else:
-                logging.warning(f"Got unknown topic message: {reply['topic']}")
-
-    async def process_responses(self):
-        while True:
-            reply = await asyncio.wait_for(self.mqtt.next_published_message(), timeout=self.timeout)
-            data = json.loads(reply['payload'])
+    # Called by the mqtt server for every message published by any client
+    def incoming_publish(self, client_id, topic, payload):
+        if client_id != self.id:
+            return
+
+        data = json.loads(payload)
+        if topic == "/sdcp/response/" + self.id:
+            self.incoming_response(data['Data']['RequestID'], data['Data'].get('Cmd'), data['Data']['Data'])
+        elif topic == "/sdcp/status/" + self.id:
+            self.incoming_status(data['Data']['Status'])
+        elif topic == "/sdcp/attributes/" + self.id:
+            # ignore these
+            pass
+        else:
+            logging.warning(f"Got unknown topic message: {topic}")
 
     def incoming_status(self, status):
         logging.debug(f"STATUS: {status}")
+        if self.desc is not None:
+            self.desc['Data']['Status'] = status
+            self.current_status = status['CurrentStatus']
+            self.busy = self.current_status > 0
+        if self.period_policy is not None:
+            self.period_policy.update(self, status)
+        for queue in self.status_subscribers:
+            queue.put(status)
 
     def incoming_response(self, id, cmd, data):
         logging.debug(f"RESPONSE: {id} -- {cmd}: {data}")
+        future = self.pending_requests.get(id)
+        if future is None:
+            logging.warning(f"Got unexpected RESPONSE (no outstanding request) {id}: {data}")
+        elif not future.done():
+            future.set_result(data)
 
     def describe(self):
         attrs = self.desc['Data']['Attributes']
@@ -323,8 +499,10 @@ class SaturnPrinter:
             },
             "Id": self.desc['Id']
         }
-        self.mqtt.publish('/sdcp/request/' + self.id, json.dumps(cmd_data))
-        return hexstr
+        # requests aren't queued for a disconnected printer; by the time it
+        # came back, whoever sent them would have given up waiting
+        msg = self.mqtt.publish('/sdcp/request/' + self.id, json.dumps(cmd_data), queue_offline=False)
+        return hexstr, msg
 
     def connect_mqtt(self, mqtt_host, mqtt_port):
         """
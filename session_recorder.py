@@ -0,0 +1,98 @@
+#
+# Cassini
+#
+# Copyright (C) 2023 Vladimir Vukicevic
+# License: MIT
+#
+# Recording of everything cassini exchanges with printers (UDP discovery
+# replies, MQTT frames, HTTP requests and responses) into a compact binary
+# log. See session_replayer.py for playing one back.
+#
+# The log starts with MAGIC, followed by records of a fixed header
+# (RECORD_HEADER: seconds since start, kind, direction, peer IPv4 address
+# and port, payload length) and the payload.
+#
+
+import time
+import struct
+import socket
+import logging
+
+MAGIC = b'CASSINI-REC1\n'
+RECORD_HEADER = struct.Struct('!dBB4sHI')
+
+# record kinds
+REC_UDP = 1             # a UDP datagram from a printer
+REC_MQTT = 2            # one complete MQTT frame
+REC_MQTT_OPEN = 3       # MQTT connection accepted
+REC_MQTT_CLOSE = 4
+REC_HTTP_REQUEST = 5    # HTTP request header
+REC_HTTP_RESPONSE = 6   # HTTP response header
+REC_HTTP_BODY = 7       # HTTP response body finished; payload is the byte count
+REC_HTTP_OPEN = 8
+REC_HTTP_CLOSE = 9
+
+DIR_IN = 0              # from the printer
+DIR_OUT = 1             # to the printer
+
+# The active recorder, if any; the servers and SaturnPrinter call record(),
+# which does nothing unless start() was called
+current = None
+
+class SessionRecorder:
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = open(filename, 'wb')
+        self.file.write(MAGIC)
+        self.start = time.monotonic()
+        self.count = 0
+
+    def record(self, kind, direction, addr, payload=b''):
+        try:
+            ip = socket.inet_aton(addr[0])
+            port = addr[1]
+        except (OSError, TypeError, IndexError):
+            ip = bytes(4)
+            port = 0
+        self.file.write(RECORD_HEADER.pack(time.monotonic() - self.start, kind, direction, ip, port, len(payload)))
+        self.file.write(payload)
+        self.count += 1
+
+    def close(self):
+        self.file.close()
+
+def start(filename):
+    global current
+    current = SessionRecorder(filename)
+    logging.info(f"Recording session to {filename}")
+    return current
+
+def stop():
+    global current
+    if current is not None:
+        current.close()
+        logging.info(f"Recorded {current.count} records to {current.filename}")
+        current = None
+
+def record(kind, direction, addr, payload=b''):
+    if current is not None:
+        current.record(kind, direction, addr, payload)
+
+# Yields (time, kind, direction, (ip, port), payload) for each record in a log
+def read_records(filename):
+    with open(filename, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{filename} is not a cassini session log")
+        while True:
+            head = f.read(RECORD_HEADER.size)
+            if not head:
+                break
+            if len(head) < RECORD_HEADER.size:
+                logging.warning(f"{filename}: truncated record at end of log")
+                break
+            t, kind, direction, ip, port, length = RECORD_HEADER.unpack(head)
+            payload = f.read(length)
+            if len(payload) < length:
+                logging.warning(f"{filename}: truncated record at end of log")
+                break
+            yield t, kind, direction, (socket.inet_ntoa(ip), port), payload
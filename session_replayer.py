@@ -0,0 +1,219 @@
+#
+# Cassini
+#
+# Copyright (C) 2023 Vladimir Vukicevic
+# License: MIT
+#
+
+import os
+import json
+import time
+import struct
+import asyncio
+import logging
+import tempfile
+
+from simple_mqtt_server import SimpleMQTTServer, MQTT_PUBLISH
+from simple_http_server import SimpleHTTPServer
+from saturn_printer import SaturnPrinter
+from session_recorder import (
+    read_records, DIR_IN, REC_UDP, REC_MQTT, REC_MQTT_OPEN, REC_MQTT_CLOSE,
+    DIR_OUT, REC_HTTP_REQUEST, REC_HTTP_RESPONSE, REC_HTTP_BODY, REC_HTTP_OPEN, REC_HTTP_CLOSE
+)
+
+# Replays a recorded log against a fresh SimpleMQTTServer and
+# SimpleHTTPServer: printers are recreated from the recorded discovery
+# replies and attached to the server as if the handshake had happened, the
+# printers' side of each MQTT connection is sent to the server, and the
+# recorded HTTP requests are made again (against files of the recorded size).
+# With fast, records are sent as quickly as possible instead of at the
+# recorded times.
+class SessionReplayer:
+    def __init__(self, filename, fast=False):
+        self.filename = filename
+        self.fast = fast
+        self.records = list(read_records(filename))
+        self.printers = []
+        self.connections = {}
+        self.request_times = {}
+        self.drain_tasks = []
+        self.tempfiles = []
+
+        self.mqtt_frames = 0
+        self.statuses = 0
+        self.http_requests = 0
+        self.http_bytes = 0
+        self.http_time = 0
+        self.recorded_http_time = 0
+        self.recorded_http_bytes = 0
+
+    async def replay(self):
+        mqtt = SimpleMQTTServer('127.0.0.1', 0)
+        await mqtt.start()
+        mqtt_task = asyncio.create_task(mqtt.serve_forever())
+        http = SimpleHTTPServer('127.0.0.1', 0)
+        await http.start()
+        http_task = asyncio.create_task(http.serve_forever())
+        await asyncio.sleep(0)
+
+        def count_status(client_id, topic, payload):
+            if topic.startswith("/sdcp/status/"):
+                self.statuses += 1
+        mqtt.add_publish_listener(count_status)
+
+        for t, kind, direction, addr, payload in self.records:
+            if kind == REC_UDP and direction == DIR_IN:
+                try:
+                    printer = SaturnPrinter(addr, json.loads(payload))
+                except (ValueError, KeyError):
+                    continue
+                if any(p.id == printer.id for p in self.printers):
+                    continue
+                printer.mqtt = mqtt
+                printer.http = http
+                printer.listen()
+                mqtt.attach_printer(printer.id, printer)
+                self.printers.append(printer)
+
+        self.register_requests(mqtt)
+        self.register_http_files(http)
+
+        start = time.monotonic()
+        try:
+            for t, kind, direction, addr, payload in self.records:
+                if not self.fast:
+                    delay = start + t - time.monotonic()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                await self.replay_record(mqtt, http, kind, direction, addr, payload)
+
+            for _, writer in self.connections.values():
+                writer.write_eof()
+            await asyncio.wait_for(asyncio.gather(*self.drain_tasks, return_exceptions=True), timeout=10)
+        finally:
+            self.elapsed = time.monotonic() - start
+            for p in self.printers:
+                p.unlisten()
+                p.pending_requests = {}
+            mqtt.server.close()
+            http.server.close()
+            mqtt_task.cancel()
+            http_task.cancel()
+            for name in self.tempfiles:
+                os.unlink(name)
+
+        return self.stats()
+
+    async def replay_record(self, mqtt, http, kind, direction, addr, payload):
+        if kind == REC_MQTT_OPEN:
+            await self.open_connection(addr, mqtt.port, self.drain_mqtt)
+        elif kind == REC_HTTP_OPEN:
+            await self.open_connection(addr, http.port, self.drain_http)
+        elif kind in (REC_MQTT, REC_HTTP_REQUEST) and direction == DIR_IN:
+            if addr not in self.connections:
+                logging.debug(f"Replay: data for unknown connection {addr}")
+                return
+            if kind == REC_MQTT:
+                self.mqtt_frames += 1
+            else:
+                self.http_requests += 1
+                self.request_times.setdefault(addr, time.monotonic())
+            writer = self.connections[addr][1]
+            writer.write(payload)
+            await writer.drain()
+        elif kind in (REC_MQTT_CLOSE, REC_HTTP_CLOSE):
+            # half-close, so whatever the server still has to say can be read
+            if addr in self.connections:
+                self.connections.pop(addr)[1].write_eof()
+
+    async def open_connection(self, addr, port, drain):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        self.connections[addr] = (reader, writer)
+
+        async def drain_and_close():
+            try:
+                await drain(addr, reader)
+            finally:
+                writer.close()
+        self.drain_tasks.append(asyncio.create_task(drain_and_close()))
+
+    async def drain_mqtt(self, addr, reader):
+        while await reader.read(65536):
+            pass
+
+    # time HTTP from the first request to the last byte of response
+    async def drain_http(self, addr, reader):
+        last = None
+        while True:
+            data = await reader.read(1024 * 1024)
+            if not data:
+                break
+            self.http_bytes += len(data)
+            last = time.monotonic()
+        if last is not None and addr in self.request_times:
+            self.http_time += last - self.request_times[addr]
+
+    # The replayed responses answer requests we don't send again; make them
+    # outstanding, so the printers take the responses as they did when recorded
+    def register_requests(self, mqtt):
+        printers = { p.id: p for p in self.printers }
+        loop = asyncio.get_running_loop()
+        for t, kind, direction, addr, payload in self.records:
+            if kind != REC_MQTT or direction != DIR_OUT or payload[0] >> 4 != MQTT_PUBLISH:
+                continue
+            length, length_bytes = mqtt.decode_length(payload[1:])
+            body = payload[1 + length_bytes:1 + length_bytes + length]
+            try:
+                topic, _, message = mqtt.parse_publish(body, (payload[0] >> 1) & 0x3)
+                if not topic.startswith("/sdcp/request/"):
+                    continue
+                data = json.loads(message)['Data']
+                printer = printers[data['MainboardID']]
+            except (ValueError, KeyError, TypeError):
+                continue
+            printer.pending_requests[data['RequestID']] = loop.create_future()
+
+    # Serve a file of the recorded size at each path that was served (200)
+    def register_http_files(self, http):
+        pending = {}
+        sizes = {}
+        for t, kind, direction, addr, payload in self.records:
+            if kind == REC_HTTP_REQUEST:
+                parts = payload.split(b'\r\n', 1)[0].split()
+                if len(parts) >= 2:
+                    pending[addr] = (parts[1].decode('latin-1'), t)
+            elif kind == REC_HTTP_RESPONSE and addr in pending:
+                lines = payload.decode('latin-1').split('\r\n')
+                status = lines[0].split()
+                # paths that were 404 (or 304, etc.) stay that way
+                if len(status) < 2 or status[1] != '200':
+                    continue
+                for line in lines[1:]:
+                    name, _, value = line.partition(':')
+                    if name.lower() == 'content-length':
+                        sizes[pending[addr][0]] = int(value)
+            elif kind == REC_HTTP_BODY and addr in pending:
+                self.recorded_http_time += t - pending.pop(addr)[1]
+                self.recorded_http_bytes += struct.unpack('!Q', payload)[0]
+
+        for path, size in sizes.items():
+            fd, name = tempfile.mkstemp(prefix='cassini-replay-')
+            with os.fdopen(fd, 'wb') as f:
+                f.truncate(size)
+            self.tempfiles.append(name)
+            http.register_file_route(path, name)
+
+    def stats(self):
+        duration = self.records[-1][0] if self.records else 0
+        return {
+            'records': len(self.records),
+            'printers': len(self.printers),
+            'mqtt_frames': self.mqtt_frames,
+            'statuses': self.statuses,
+            'http_requests': self.http_requests,
+            'http_bytes': self.http_bytes,
+            'http_throughput': self.http_bytes / self.http_time if self.http_time > 0 else None,
+            'recorded_http_throughput': self.recorded_http_bytes / self.recorded_http_time if self.recorded_http_time > 0 else None,
+            'recorded_duration': duration,
+            'replay_duration': self.elapsed,
+        }
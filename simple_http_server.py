@@ -7,33 +7,56 @@
 
 import logging
 import asyncio
-import os
+import time
+import struct
 import hashlib
 
+import session_recorder
+from session_recorder import DIR_IN, DIR_OUT, REC_HTTP_OPEN, REC_HTTP_CLOSE, REC_HTTP_REQUEST, REC_HTTP_RESPONSE, REC_HTTP_BODY
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
 class SimpleHTTPServer:
     BufferSize = 1024768
+    MaxHeaderSize = 8192
+    KeepAliveTimeout = 30
+    MaxKeepAliveRequests = 100
+
+    StatusReasons = {
+        200: "OK",
+        304: "Not Modified",
+        400: "Bad Request",
+        404: "Not Found",
+        405: "Method Not Allowed",
+        431: "Request Header Fields Too Large",
+        505: "HTTP Version Not Supported",
+    }
 
-    def __init__(self, host="0.0.0.0", port=0):
+    def __init__(self, host="0.0.0.0", port=0, tuning=None):
         self.host = host
         self.port = port
         self.server = None
         self.routes = {}
+        # a TransferTuning with per-printer socket settings, if any
+        self.tuning = tuning
+        # ip -> bytes/second of the last GET to that address
+        self.throughput = {}
 
-    def register_file_route(self, path, filename):
-        size = os.path.getsize(filename)
-        md5 = hashlib.md5()
-        with open(filename, 'rb') as f:
-            while True:
-                data = f.read(1024)
-                if not data:
-                    break
-                md5.update(data)
-        route = { 'file': filename, 'size': size, 'md5': md5.hexdigest() }
+    # fileinfo is the file's fingerprint_file(), if the caller already has it
+    def register_file_route(self, path, filename, fileinfo=None):
+        if fileinfo is None:
+            fileinfo = fingerprint_file(filename)
+        route = { 'file': filename, 'size': fileinfo['size'], 'md5': fileinfo['md5'], 'handle': None }
         self.routes[path] = route
         return route
 
     def unregister_file_route(self, path):
-        del self.routes[path]
+        route = self.routes.pop(path)
+        if route['handle'] is not None:
+            route['handle'].close()
 
     async def start(self):
         self.server = await asyncio.start_server(self.handle_client, self.host, self.port)
@@ -46,56 +69,218 @@ class SimpleHTTPServer:
     async def handle_client(self, reader, writer):
         try:
             await self.handle_client_inner(reader, writer)
+        except asyncio.CancelledError:
+            # shutting down; asyncio's stream callback logs a traceback for a
+            # handler task that ends cancelled
+            pass
         except Exception as e:
             logging.error(f"HTTP Exception handling client: {e}")
 
     async def handle_client_inner(self, reader, writer):
-        logging.debug(f"HTTP connection from {writer.get_extra_info('peername')}")
+        addr = writer.get_extra_info('peername')
+        logging.debug(f"HTTP connection from {addr}")
+        session_recorder.record(REC_HTTP_OPEN, DIR_IN, addr)
+        chunk_size = self.BufferSize
+        if self.tuning is not None:
+            profile = self.tuning.profile_for(addr[0])
+            self.tuning.apply(writer.get_extra_info('socket'), profile)
+            chunk_size = profile['chunk_size']
         data = b''
+        count = 0
+        try:
+            # The printer probes the file (HEAD) around transfers; serve any number
+            # of requests on the one connection until either side wants to stop
+            while count < self.MaxKeepAliveRequests:
+                try:
+                    request, data = await self.read_request(reader, data, addr)
+                except HTTPError as e:
+                    logging.debug(f"HTTP bad request from {addr}: {e.status} {e}")
+                    await self.send_response(writer, e.status, keep_alive=False)
+                    break
+                if request is None:
+                    break
+                count += 1
+                if count >= self.MaxKeepAliveRequests:
+                    # tell the client this is the last one
+                    request['keep_alive'] = False
+                if not await self.handle_request(writer, request, chunk_size):
+                    break
+        except asyncio.TimeoutError:
+            logging.debug(f"HTTP connection from {addr} idle, closing")
+        finally:
+            session_recorder.record(REC_HTTP_CLOSE, DIR_OUT, addr)
+            writer.close()
+            await writer.wait_closed()
+            logging.debug(f"HTTP connection closed after {count} requests")
+
+    # Read one request's headers. Returns (request, leftover data), or
+    # (None, b'') if the connection was closed between requests.
+    async def read_request(self, reader, data, addr=None):
+        scan_from = 0
         while True:
-            data += await reader.read(1024)
-            if b'\r\n\r\n' in data:
+            end = data.find(b'\r\n\r\n', scan_from)
+            if end >= 0:
                 break
+            if len(data) > self.MaxHeaderSize:
+                raise HTTPError(431, "request header too large")
+            # the terminator could straddle the next read
+            scan_from = max(0, len(data) - 3)
+            chunk = await asyncio.wait_for(reader.read(4096), timeout=self.KeepAliveTimeout)
+            if not chunk:
+                if data.strip():
+                    raise HTTPError(400, "connection closed mid-request")
+                return None, b''
+            data += chunk
+
+        if end > self.MaxHeaderSize:
+            raise HTTPError(431, "request header too large")
+
+        session_recorder.record(REC_HTTP_REQUEST, DIR_IN, addr, data[:end + 4])
+        lines = data[:end].decode('latin-1').split('\r\n')
+        data = data[end + 4:]
+        logging.debug(f"HTTP request: {lines}")
+
+        try:
+            method, path, version = lines[0].split()
+        except ValueError:
+            raise HTTPError(400, f"bad request line {lines[0]!r}")
+        if not version.startswith('HTTP/1.'):
+            raise HTTPError(505, f"unsupported version {version}")
+
+        headers = {}
+        for line in lines[1:]:
+            name, sep, value = line.partition(':')
+            if not sep:
+                raise HTTPError(400, f"bad header line {line!r}")
+            headers[name.strip().lower()] = value.strip()
+
+        # We don't accept bodies, but skip over one so the next request parses
+        try:
+            body_length = int(headers.get('content-length', 0))
+        except ValueError:
+            raise HTTPError(400, "bad Content-Length")
+        if body_length < 0:
+            raise HTTPError(400, "negative Content-Length")
+        while len(data) < body_length:
+            chunk = await asyncio.wait_for(reader.read(4096), timeout=self.KeepAliveTimeout)
+            if not chunk:
+                raise HTTPError(400, "connection closed mid-body")
+            data += chunk
+        data = data[body_length:]
 
-        logging.debug(f"HTTP request: {data}")
-        request_line = data.decode().splitlines()[0]
-        method, path, _ = request_line.split()
+        connection = headers.get('connection', '').lower()
+        if version == 'HTTP/1.0':
+            keep_alive = connection == 'keep-alive'
+        else:
+            keep_alive = connection != 'close'
+
+        return { 'method': method, 'path': path, 'version': version, 'headers': headers, 'keep_alive': keep_alive }, data
+
+    # Returns whether the connection should be kept open
+    async def handle_request(self, writer, request, chunk_size=None):
+        method = request['method']
+        path = request['path']
+        keep_alive = request['keep_alive']
+
+        if method not in ("GET", "HEAD"):
+            await self.send_response(writer, 405, { 'Allow': 'GET, HEAD' }, keep_alive=keep_alive)
+            return keep_alive
 
         if path not in self.routes:
             logging.debug(f"HTTP path {path} not found in routes")
             logging.debug(self.routes)
-            writer.write("HTTP/1.1 404 Not Found\r\n".encode())
-            writer.close()
-            return
+            await self.send_response(writer, 404, keep_alive=keep_alive)
+            return keep_alive
 
         route = self.routes[path]
         logging.debug(f"HTTP method {method} path {path} route: {route}")
 
-        header = f"HTTP/1.1 200 OK\r\n"
-        #header += f"Content-Type: application/octet-stream\r\n"
-        header += f"Content-Type: text/plain; charset=utf-8\r\n"
-        header += f"Etag: {route['md5']}\r\n"
-        header += f"Content-Length: {route['size']}\r\n"
+        if self.etag_matches(request['headers'].get('if-none-match'), route['md5']):
+            await self.send_response(writer, 304, { 'Etag': route['md5'] }, keep_alive=keep_alive)
+            return keep_alive
+
+        headers = {
+            #'Content-Type': 'application/octet-stream',
+            'Content-Type': 'text/plain; charset=utf-8',
+            'Etag': route['md5'],
+            'Content-Length': route['size']
+        }
+        await self.send_response(writer, 200, headers, keep_alive=keep_alive, content_length=None)
+
+        if method == "GET":
+            # The file stays open between requests; there's no await between the
+            # seek and the read, so concurrent transfers of it don't interfere
+            f = self.route_file(route)
+            offset = 0
+            start = time.monotonic()
+            while offset < route['size']:
+                f.seek(offset)
+                data = f.read(chunk_size or self.BufferSize)
+                if not data:
+                    break
+                writer.write(data)
+                offset += len(data)
+                logging.debug(f"HTTP wrote {len(data)} bytes")
+                await writer.drain()
+            logging.debug(f"HTTP wrote total {offset} bytes")
+            self.transfer_finished(writer.get_extra_info('peername'), offset, time.monotonic() - start)
+            session_recorder.record(REC_HTTP_BODY, DIR_OUT, writer.get_extra_info('peername'), struct.pack('!Q', offset))
+            if offset != route['size']:
+                # file changed under us; the length we promised is wrong
+                logging.error(f"HTTP {path}: file is shorter than expected ({offset} < {route['size']})")
+                return False
+
+        await writer.drain()
+        return keep_alive
+
+    def transfer_finished(self, addr, nbytes, seconds):
+        if seconds > 0:
+            self.throughput[addr[0]] = nbytes / seconds
+        if self.tuning is not None:
+            self.tuning.record_transfer(addr[0], nbytes, seconds)
+
+    async def send_response(self, writer, status, headers=None, keep_alive=False, content_length=0):
+        header = f"HTTP/1.1 {status} {self.StatusReasons.get(status, '')}\r\n"
+        for name, value in (headers or {}).items():
+            header += f"{name}: {value}\r\n"
+        if content_length is not None and status != 304:
+            header += f"Content-Length: {content_length}\r\n"
+        header += f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n"
         header += "\r\n"
 
         logging.debug(f"Writing header:\n{header}")
+        session_recorder.record(REC_HTTP_RESPONSE, DIR_OUT, writer.get_extra_info('peername'), header.encode())
         writer.write(header.encode())
+        await writer.drain()
 
-        if method == "GET":
-            total = 0
-            with open(route['file'], 'rb') as f:
-                while True:
-                    data = f.read(self.BufferSize)
-                    if not data:
-                        break
-                    writer.write(data)
-                    logging.debug(f"HTTP wrote {len(data)} bytes")
-                    #await asyncio.sleep(1)
-                    total += len(data)
-            logging.debug(f"HTTP wrote total {total} bytes")
+    def etag_matches(self, if_none_match, etag):
+        if if_none_match is None:
+            return False
+        for tag in if_none_match.split(','):
+            tag = tag.strip()
+            if tag == '*':
+                return True
+            if tag.startswith('W/'):
+                tag = tag[2:]
+            if tag.strip('"') == etag:
+                return True
+        return False
 
-        await writer.drain()
-        writer.close()
-        await writer.wait_closed()
-        logging.debug(f"HTTP connection closed")
+    def route_file(self, route):
+        if route['handle'] is None:
+            route['handle'] = open(route['file'], 'rb')
+        return route['handle']
 
+# Size and MD5 of a file, read in BufferSize chunks. This is blocking; from
+# the event loop, run it in an executor.
+def fingerprint_file(filename):
+    md5 = hashlib.md5()
+    size = 0
+    with open(filename, 'rb') as f:
+        while True:
+            data = f.read(SimpleHTTPServer.BufferSize)
+            if not data:
+                break
+            md5.update(data)
+            size += len(data)
+    return { 'size': size, 'md5': md5.hexdigest() }
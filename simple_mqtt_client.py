@@ -0,0 +1,179 @@
+#
+# Cassini
+#
+# Copyright (C) 2023 Vladimir Vukicevic
+# License: MIT
+#
+
+import logging
+import asyncio
+import struct
+
+from simple_mqtt_server import (
+    MQTT_CONNECT, MQTT_CONNACK, MQTT_PUBLISH, MQTT_PUBACK, MQTT_SUBSCRIBE,
+    MQTT_SUBACK, MQTT_PINGREQ, MQTT_PINGRESP, MQTT_DISCONNECT
+)
+
+# Just enough of an MQTT 3.1.1 client to talk to a broker. Publishes are
+# buffered and only written out on flush(), so that a burst of them goes out
+# in a single write.
+class SimpleMQTTClient:
+    def __init__(self, host, port, client_id, keepalive=60, qos0_packet_ids=False, local_addr=None):
+        self.host = host
+        self.port = int(port)
+        self.client_id = client_id
+        self.keepalive = keepalive
+        self.reader = None
+        self.writer = None
+        self.read_task = None
+        self.ping_task = None
+        self.pending = []
+        self.next_pack_id_value = 1
+        # called as on_message(topic, payload) for every PUBLISH from the broker
+        self.on_message = None
+        self.closed = asyncio.Event()
+        # SimpleMQTTServer sends a packet identifier even in QoS 0 publishes
+        # (unless created with qos0_packet_ids=False), which is what the
+        # printers expect; set this when talking to it
+        self.qos0_packet_ids = qos0_packet_ids
+        self.local_addr = local_addr
+
+    @property
+    def connected(self):
+        return self.writer is not None and not self.closed.is_set()
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port, local_addr=self.local_addr)
+        self.closed.clear()
+
+        client_id = self.client_id.encode('utf-8')
+        # protocol name, level 4 (3.1.1), clean session flag
+        body = b'\x00\x04MQTT\x04\x02' + struct.pack("!H", self.keepalive)
+        body += struct.pack("!H", len(client_id)) + client_id
+        self.writer.write(self.encode_msg(MQTT_CONNECT, body))
+        await self.writer.drain()
+
+        connack = await self.reader.readexactly(4)
+        if connack[0] >> 4 != MQTT_CONNACK or connack[3] != 0:
+            self.writer.close()
+            raise ConnectionError(f"MQTT broker {self.host}:{self.port} refused connection: {connack}")
+        logging.debug(f"MQTT client {self.client_id} connected to {self.host}:{self.port}")
+
+        self.read_task = asyncio.create_task(self.read_loop())
+        if self.keepalive > 0:
+            self.ping_task = asyncio.create_task(self.ping_loop())
+
+    async def disconnect(self):
+        if self.writer is None:
+            return
+        try:
+            await self.flush()
+            self.writer.write(self.encode_msg(MQTT_DISCONNECT))
+            await self.writer.drain()
+        except ConnectionError:
+            pass
+        self.close()
+
+    def close(self):
+        for task in (self.read_task, self.ping_task):
+            if task is not None and task is not asyncio.current_task():
+                task.cancel()
+        if self.writer is not None:
+            self.writer.close()
+        self.closed.set()
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        topic = topic.encode('utf-8')
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        body = struct.pack("!H", len(topic)) + topic
+        if qos > 0:
+            body += struct.pack("!H", self.next_pack_id())
+        body += payload
+        flags = (qos << 1) | (1 if retain else 0)
+        self.pending.append(self.encode_msg(MQTT_PUBLISH, body, flags))
+
+    # Write out everything published since the last flush in one go
+    async def flush(self):
+        if not self.pending:
+            return 0
+        if not self.connected:
+            raise ConnectionError("MQTT client not connected")
+        count = len(self.pending)
+        data = b''.join(self.pending)
+        self.pending = []
+        self.writer.write(data)
+        await self.writer.drain()
+        return count
+
+    async def subscribe(self, topic, qos=0):
+        topic = topic.encode('utf-8')
+        body = struct.pack("!H", self.next_pack_id()) + struct.pack("!H", len(topic)) + topic + bytes([qos])
+        self.writer.write(self.encode_msg(MQTT_SUBSCRIBE, body, 0x2))
+        await self.writer.drain()
+
+    async def ping_loop(self):
+        try:
+            while True:
+                await asyncio.sleep(self.keepalive / 2)
+                self.writer.write(self.encode_msg(MQTT_PINGREQ))
+                await self.writer.drain()
+        except ConnectionError as e:
+            logging.warning(f"MQTT client {self.client_id}: ping failed: {e}")
+            self.close()
+
+    async def read_loop(self):
+        try:
+            while True:
+                head = await self.reader.readexactly(1)
+                msg_type = head[0] >> 4
+                msg_flags = head[0] & 0xf
+                length = 0
+                multiplier = 1
+                while True:
+                    byte = (await self.reader.readexactly(1))[0]
+                    length += (byte & 0x7f) * multiplier
+                    if byte & 0x80 == 0:
+                        break
+                    multiplier *= 128
+                message = await self.reader.readexactly(length)
+
+                if msg_type == MQTT_PUBLISH:
+                    qos = (msg_flags >> 1) & 0x3
+                    topic_len = struct.unpack("!H", message[0:2])[0]
+                    topic = message[2:2 + topic_len].decode('utf-8')
+                    start = 2 + topic_len
+                    if qos > 0 or self.qos0_packet_ids:
+                        packid = struct.unpack("!H", message[start:start + 2])[0]
+                        start += 2
+                    if qos > 0:
+                        self.writer.write(self.encode_msg(MQTT_PUBACK, struct.pack("!H", packid)))
+                    if self.on_message is not None:
+                        self.on_message(topic, message[start:].decode('utf-8'))
+                elif msg_type in (MQTT_PUBACK, MQTT_SUBACK, MQTT_PINGRESP):
+                    pass
+                else:
+                    logging.debug(f"MQTT client {self.client_id}: ignoring message type {msg_type}")
+        except (asyncio.IncompleteReadError, ConnectionError) as e:
+            logging.info(f"MQTT client {self.client_id}: connection to {self.host}:{self.port} lost")
+            self.close()
+
+    def encode_msg(self, msg_type, body=b'', flags=0):
+        return bytes([msg_type << 4 | flags]) + self.encode_length(len(body)) + body
+
+    def encode_length(self, length):
+        encoded = bytearray()
+        while True:
+            digit = length % 128
+            length //= 128
+            if length > 0:
+                digit |= 0x80
+            encoded.append(digit)
+            if length == 0:
+                break
+        return bytes(encoded)
+
+    def next_pack_id(self):
+        pack_id = self.next_pack_id_value
+        self.next_pack_id_value = pack_id % 0xffff + 1
+        return pack_id
@@ -8,6 +8,10 @@
 import logging
 import asyncio
 import struct
+import time
+
+import session_recorder
+from session_recorder import DIR_IN, DIR_OUT, REC_MQTT, REC_MQTT_OPEN, REC_MQTT_CLOSE
 
 MQTT_CONNECT = 1
 MQTT_CONNACK = 2
@@ -15,17 +19,80 @@ MQTT_PUBLISH = 3
 MQTT_PUBACK = 4
 MQTT_SUBSCRIBE = 8
 MQTT_SUBACK = 9
+MQTT_UNSUBSCRIBE = 10
+MQTT_UNSUBACK = 11
+MQTT_PINGREQ = 12
+MQTT_PINGRESP = 13
 MQTT_DISCONNECT = 14
 
+# Server-side state for one client ID. This outlives the TCP connection, so
+# that a printer that drops off and comes back keeps its subscriptions, gets
+# any messages that were published while it was away, and stays attached to
+# the SaturnPrinter that was driving it.
+class MQTTSession:
+    def __init__(self, client_id):
+        self.client_id = client_id
+        self.subscribed_topics = dict()
+        self.outgoing_messages = asyncio.Queue()
+        self.online = asyncio.Event()
+        self.writer = None
+        self.addr = None
+        self.keepalive = 0
+        # how often (ms) the client was told to publish status, if it was
+        self.status_period = None
+        self.last_seen = None
+        self.connect_count = 0
+        self.printer = None
+        # when the client last went offline (or the session was created)
+        self.offline_since = time.monotonic()
+
+    @property
+    def connected(self):
+        return self.writer is not None
+
+    # Put a message that was taken off the queue but never written back at the front
+    def requeue(self, msg):
+        pending = [msg]
+        while not self.outgoing_messages.empty():
+            pending.append(self.outgoing_messages.get_nowait())
+        for m in pending:
+            self.outgoing_messages.put_nowait(m)
+
+    # Take a message back out of the queue; returns whether it was still there
+    def withdraw(self, msg):
+        pending = []
+        while not self.outgoing_messages.empty():
+            pending.append(self.outgoing_messages.get_nowait())
+        for m in pending:
+            if m is not msg:
+                self.outgoing_messages.put_nowait(m)
+        return len(pending) != self.outgoing_messages.qsize()
+
 class SimpleMQTTServer:
-    def __init__(self, host, port):
+    # A client is considered dead if we hear nothing from it for this multiple
+    # of its keepalive interval (the MQTT spec says 1.5)
+    KeepaliveGrace = 1.5
+    # ...or for this multiple of the status period it was told to publish at,
+    # if that's longer
+    StatusGrace = 3
+    # Sessions of clients that have been offline this long (seconds) are
+    # dropped, along with anything queued for them
+    SessionExpiry = 3600
+
+    # The printer firmware puts a packet ID in every PUBLISH, including QoS 0
+    # ones, and expects the same from us. With qos0_packet_ids unset, QoS 0
+    # publishes are read and written as the MQTT spec has them instead, for
+    # standard clients (e.g. standing in for an upstream broker).
+    def __init__(self, host, port, qos0_packet_ids=True):
         self.host = host
         self.port = port
         self.server = None
-        self.incoming_messages = asyncio.Queue()
-        self.outgoing_messages = asyncio.Queue()
-        self.connected_clients = {}
+        self.sessions = {}
+        self.publish_listeners = []
+        # topic -> last retained payload published to it, sent to new subscribers
+        self.retained = {}
         self.next_pack_id_value = 1
+        self.qos0_packet_ids = qos0_packet_ids
 
     async def start(self):
         self.server = await asyncio.start_server(self.handle_client, self.host, self.port)
@@ -38,120 +105,298 @@ class SimpleMQTTServer:
         self.client_subscribed = loop.create_future()
         await self.server.serve_forever()
 
-    def publish(self, topic, payload):
-        self.outgoing_messages.put_nowait({'topic': topic, 'payload': payload})
-
-    async def next_published_message(self):
-        return await self.incoming_messages.get()
+    @property
+    def connected_clients(self):
+        return { cid: s.addr for cid, s in self.sessions.items() if s.connected }
+
+    def session(self, client_id):
+        if client_id not in self.sessions:
+            self.sessions[client_id] = MQTTSession(client_id)
+        return self.sessions[client_id]
+
+    def is_connected(self, client_id):
+        return client_id in self.sessions and self.sessions[client_id].connected
+
+    # Remember which SaturnPrinter owns this client ID, so that a reconnect
+    # can pick up where it left off
+    def attach_printer(self, client_id, printer):
+        self.session(client_id).printer = printer
+
+    def attached_printer(self, client_id):
+        if client_id not in self.sessions:
+            return None
+        return self.sessions[client_id].printer
+
+    # Record the status period (ms) a printer acknowledged; it publishes that
+    # often whether or not anything changed, which counts as traffic
+    def set_status_period(self, client_id, period):
+        self.session(client_id).status_period = period
+
+    async def wait_for_client(self, client_id):
+        await self.session(client_id).online.wait()
+
+    def drop_session(self, client_id):
+        session = self.sessions.pop(client_id, None)
+        if session is None:
+            return
+        if session.writer is not None:
+            session.writer.close()
+        if session.printer is not None:
+            session.printer.session_dropped()
+
+    def expire_sessions(self):
+        now = time.monotonic()
+        for cid, session in list(self.sessions.items()):
+            if not session.connected and now - session.offline_since > self.SessionExpiry:
+                logging.debug(f"MQTT client {cid} offline for {now - session.offline_since:.0f}s, dropping session")
+                self.drop_session(cid)
+
+    # Queue a message for every session subscribed to topic. Offline sessions
+    # get it when they reconnect, unless queue_offline is unset (e.g. for
+    # requests that will have timed out by then). Returns the queued message,
+    # to withdraw() it, or None if no session took it.
+    def publish(self, topic, payload, queue_offline=True):
+        msg = {'topic': topic, 'payload': payload}
+        delivered = False
+        for session in self.sessions.values():
+            if topic in session.subscribed_topics and (queue_offline or session.connected):
+                session.outgoing_messages.put_nowait(msg)
+                delivered = True
+        if not delivered:
+            logging.debug(f'SEND: NOT DELIVERED {topic}: {payload}')
+            return None
+        return msg
+
+    # Take a published message back out of any queue it's still waiting in
+    def withdraw(self, msg):
+        for session in self.sessions.values():
+            if session.withdraw(msg):
+                logging.debug(f"MQTT client {session.client_id}: withdrew unsent message on {msg['topic']}")
+
+    # Listeners are called as listener(client_id, topic, payload) for every
+    # PUBLISH received from a client
+    def add_publish_listener(self, listener):
+        self.publish_listeners.append(listener)
+
+    def remove_publish_listener(self, listener):
+        self.publish_listeners.remove(listener)
 
     async def handle_client(self, reader, writer):
         try:
             await self.handle_client_inner(reader, writer)
+        except asyncio.CancelledError:
+            # shutting down; asyncio's stream callback logs a traceback for a
+            # handler task that ends cancelled
+            pass
         except Exception as e:
             logging.error(f"MQTT Exception handling client: {e}")
 
     async def handle_client_inner(self, reader, writer):
         addr = writer.get_extra_info('peername')
         logging.debug(f'Socket connected from {addr}')
+        session_recorder.record(REC_MQTT_OPEN, DIR_IN, addr)
         data = b''
 
-        subscribed_topics = dict()
-        client_id = None
+        session = None
+        deadline = None
+        # message taken off the session queue but not yet written out
+        sending = None
 
         read_future = asyncio.ensure_future(reader.read(1024))
-        outgoing_messages_future = asyncio.ensure_future(self.outgoing_messages.get())
+        outgoing_messages_future = None
 
-        while True:
-            completed, pending = await asyncio.wait([read_future, outgoing_messages_future], return_when=asyncio.FIRST_COMPLETED)
+        try:
+            while True:
+                wait_for = [read_future]
+                if outgoing_messages_future is not None:
+                    wait_for.append(outgoing_messages_future)
+
+                timeout = None
+                if deadline is not None:
+                    timeout = max(0, deadline - time.monotonic())
 
-            if outgoing_messages_future in completed:
-                outmsg = outgoing_messages_future.result()
-                topic = outmsg['topic']
-                payload = outmsg['payload']
+                completed, pending = await asyncio.wait(wait_for, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not completed:
+                    logging.warning(f"MQTT client {session.client_id} at {addr}: no traffic within keepalive, dropping")
+                    return
+
+                if outgoing_messages_future in completed:
+                    sending = outgoing_messages_future.result()
+                    outgoing_messages_future = None
+                    if session.writer is not writer:
+                        # a newer connection took over this session
+                        return
 
-                if topic in subscribed_topics:
-                    qos = subscribed_topics[topic]
-                    await self.send_msg(writer, MQTT_PUBLISH, payload=self.encode_publish(topic, payload, self.next_pack_id()))
+                    topic = sending['topic']
+                    payload = sending['payload']
+                    if topic in session.subscribed_topics:
+                        packid = self.next_pack_id() if self.qos0_packet_ids else None
+                        await self.send_msg(writer, MQTT_PUBLISH, payload=self.encode_publish(topic, payload, packid))
+                    else:
+                        logging.debug(f'SEND: NOT SUBSCRIBED {topic}: {payload}')
+                    sending = None
+                    outgoing_messages_future = asyncio.ensure_future(session.outgoing_messages.get())
+
+                if read_future in completed:
+                    d = read_future.result()
+                    if not d:
+                        logging.info(f"Client {addr} closed connection")
+                        return
+                    data += d
+                    read_future = asyncio.ensure_future(reader.read(1024))
+                    if session is not None:
+                        session.last_seen = time.monotonic()
+                        deadline = self.keepalive_deadline(session)
                 else:
-                    logging.debug(f'SEND: NOT SUBSCRIBED {topic}: {payload}')
-                #msg = (MQTT_PUBLISH, 0, topic.encode('utf-8') + payload.encode('utf-8'))
-                #await self.send_msg(writer, *msg)
-                outgoing_messages_future = asyncio.ensure_future(self.outgoing_messages.get())
-
-            if read_future in completed:
-                d = read_future.result()
-                data += d
-                read_future = asyncio.ensure_future(reader.read(1024))
-            else:
-                continue
-
-            # Process any messages
-            while True:
-                # must have at least 2 bytes
-                if len(data) < 2:
-                    break
-
-                msg_type = data[0] >> 4
-                msg_flags = data[0] & 0xf
-                #print(f" msg_type: {msg_type} msg_flags: {msg_flags}")
-                # TODO -- we could maybe not have enough bytes to decode the length, but assume
-                # that won't happen
-                msg_length, len_bytes_consumed = self.decode_length(data[1:])
-                #logging.debug(f"mqtt in msg_type: {msg_type} flags: {msg_flags} msg_length {msg_length} bytes_consumed for msg_length {len_bytes_consumed}")
-
-                # is there enough to process the message?
-                head_len = len_bytes_consumed + 1
-                if msg_length + head_len > len(data):
-                    logging.debug("Not enough")
-                    break
-
-                # pull the message payload out, and move data to next packet
-                message = data[head_len                 :head_len+msg_length]
-                data =    data[head_len+msg_length:]
-
-                if msg_type == MQTT_CONNECT:
-                    if message[0:6] != b'\x00\x04MQTT':
-                        logging.error(f"MQTT client {addr}: bad CONNECT")
-                        writer.close()
+                    continue
+
+                # Process any messages
+                while True:
+                    # must have at least 2 bytes
+                    if len(data) < 2:
+                        break
+
+                    msg_type = data[0] >> 4
+                    msg_flags = data[0] & 0xf
+                    #print(f" msg_type: {msg_type} msg_flags: {msg_flags}")
+                    # TODO -- we could maybe not have enough bytes to decode the length, but assume
+                    # that won't happen
+                    msg_length, len_bytes_consumed = self.decode_length(data[1:])
+                    #logging.debug(f"mqtt in msg_type: {msg_type} flags: {msg_flags} msg_length {msg_length} bytes_consumed for msg_length {len_bytes_consumed}")
+
+                    # is there enough to process the message?
+                    head_len = len_bytes_consumed + 1
+                    if msg_length + head_len > len(data):
+                        logging.debug("Not enough")
+                        break
+
+                    # pull the message payload out, and move data to next packet
+                    session_recorder.record(REC_MQTT, DIR_IN, addr, data[:head_len+msg_length])
+                    message = data[head_len                 :head_len+msg_length]
+                    data =    data[head_len+msg_length:]
+
+                    if session is None and msg_type != MQTT_CONNECT:
+                        logging.error(f"MQTT client {addr}: expected CONNECT, got {msg_type}")
                         return
-                    
-                    client_id_len = struct.unpack("!H", message[10:12])[0]
-                    client_id = message[12:12+client_id_len].decode("utf-8")
-
-                    logging.debug(f"MQTT client {client_id} at {addr} connected")
-                    self.connected_clients[client_id] = addr
-                    await self.send_msg(writer, MQTT_CONNACK, payload=b'\x00\x00')
-
-                    self.client_connection.set_result(client_id)
-                    self.client_connection = asyncio.get_event_loop().create_future()
-
-                elif msg_type == MQTT_PUBLISH:
-                    qos = (msg_flags >> 1) & 0x3
-                    topic, packid, content = self.parse_publish(message)
-
-                    #logging.debug(f"Got DATA on: {topic}")
-                    self.incoming_messages.put_nowait({ 'topic': topic, 'payload': content})
-                    if qos > 0:
-                        await self.send_msg(writer, MQTT_PUBACK, packet_ident=packid)
-                elif msg_type == MQTT_SUBSCRIBE:
-                    qos = (msg_flags >> 1) & 0x3
-                    packid = message[0] << 8 | message[1]
-                    message = message[2:]
-                    topic = self.parse_subscribe(message)
-                    logging.debug(f"Client {addr} subscribed to topic '{topic}', QoS {qos}")
-                    subscribed_topics[topic] = qos
-                    await self.send_msg(writer, MQTT_SUBACK, packet_ident=packid, payload=bytes([qos]))
-
-                    self.client_subscribed.set_result(topic)
-                    self.client_subscribed = asyncio.get_event_loop().create_future()
-                elif msg_type == MQTT_DISCONNECT:
-                    logging.info(f"Client {addr} disconnected")
-                    writer.close()
-                    await writer.wait_closed()
-
-                    if client_id is not None:
-                        del self.connected_clients[client_id]
-                    return
+
+                    if msg_type == MQTT_CONNECT:
+                        if message[0:6] != b'\x00\x04MQTT':
+                            logging.error(f"MQTT client {addr}: bad CONNECT")
+                            return
+
+                        connect_flags = message[7]
+                        clean_session = (connect_flags & 0x02) != 0
+                        keepalive = struct.unpack("!H", message[8:10])[0]
+                        client_id_len = struct.unpack("!H", message[10:12])[0]
+                        client_id = message[12:12+client_id_len].decode("utf-8")
+
+                        # Sessions are kept by client ID even when the client asks for a
+                        # clean session: the printer's ID is its mainboard ID, and what we
+                        # want to keep is the SaturnPrinter state on our side of it.
+                        self.expire_sessions()
+                        resumed = client_id in self.sessions and self.sessions[client_id].connect_count > 0
+                        session = self.session(client_id)
+                        if session.writer is not None and session.writer is not writer:
+                            logging.info(f"MQTT client {client_id} reconnected from {addr}, closing old connection from {session.addr}")
+                            session.writer.close()
+
+                        session.writer = writer
+                        session.addr = addr
+                        session.keepalive = keepalive
+                        session.last_seen = time.monotonic()
+                        session.connect_count += 1
+                        deadline = self.keepalive_deadline(session)
+
+                        session_present = 1 if resumed and not clean_session else 0
+                        await self.send_msg(writer, MQTT_CONNACK, payload=bytes([session_present, 0]))
+
+                        if resumed:
+                            logging.info(f"MQTT client {client_id} at {addr} resumed session (keepalive {keepalive}s, {len(session.subscribed_topics)} subscriptions)")
+                            if session.printer is not None:
+                                logging.debug(f"MQTT client {client_id} re-attached to existing printer state")
+                        else:
+                            logging.debug(f"MQTT client {client_id} at {addr} connected (keepalive {keepalive}s)")
+
+                        session.online.set()
+                        outgoing_messages_future = asyncio.ensure_future(session.outgoing_messages.get())
+
+                        self.client_connection.set_result(client_id)
+                        self.client_connection = asyncio.get_event_loop().create_future()
+
+                    elif msg_type == MQTT_PUBLISH:
+                        qos = (msg_flags >> 1) & 0x3
+                        retain = msg_flags & 0x1
+                        topic, packid, content = self.parse_publish(message, qos)
+
+                        #logging.debug(f"Got DATA on: {topic}")
+                        if retain:
+                            # an empty retained message clears the topic
+                            if content:
+                                self.retained[topic] = content
+                            else:
+                                self.retained.pop(topic, None)
+                        for listener in self.publish_listeners:
+                            try:
+                                listener(session.client_id, topic, content)
+                            except Exception as e:
+                                logging.error(f"MQTT publish listener failed: {e}")
+                        if qos > 0:
+                            await self.send_msg(writer, MQTT_PUBACK, packet_ident=packid)
+                    elif msg_type == MQTT_SUBSCRIBE:
+                        qos = (msg_flags >> 1) & 0x3
+                        packid = message[0] << 8 | message[1]
+                        message = message[2:]
+                        topic = self.parse_subscribe(message)
+                        logging.debug(f"Client {addr} subscribed to topic '{topic}', QoS {qos}")
+                        session.subscribed_topics[topic] = qos
+                        await self.send_msg(writer, MQTT_SUBACK, packet_ident=packid, payload=bytes([qos]))
+                        if topic in self.retained:
+                            # only standard clients subscribe to retained topics
+                            await self.send_msg(writer, MQTT_PUBLISH, flags=0x1,
+                                                payload=self.encode_publish(topic, self.retained[topic], None))
+
+                        self.client_subscribed.set_result(topic)
+                        self.client_subscribed = asyncio.get_event_loop().create_future()
+                    elif msg_type == MQTT_UNSUBSCRIBE:
+                        packid = message[0] << 8 | message[1]
+                        topic = self.parse_subscribe(message[2:])
+                        logging.debug(f"Client {addr} unsubscribed from topic '{topic}'")
+                        session.subscribed_topics.pop(topic, None)
+                        await self.send_msg(writer, MQTT_UNSUBACK, packet_ident=packid)
+                    elif msg_type == MQTT_PINGREQ:
+                        await self.send_msg(writer, MQTT_PINGRESP)
+                    elif msg_type == MQTT_DISCONNECT:
+                        logging.info(f"Client {addr} disconnected")
+                        return
+        finally:
+            read_future.cancel()
+            if outgoing_messages_future is not None:
+                if outgoing_messages_future.done() and not outgoing_messages_future.cancelled():
+                    sending = outgoing_messages_future.result()
+                else:
+                    outgoing_messages_future.cancel()
+            if session is not None and session.writer is writer:
+                session.writer = None
+                session.offline_since = time.monotonic()
+                session.online.clear()
+                logging.debug(f"MQTT client {session.client_id} offline, keeping session")
+            if session is not None and sending is not None:
+                session.requeue(sending)
+            session_recorder.record(REC_MQTT_CLOSE, DIR_OUT, addr)
+            writer.close()
+
+    # When to give up on a client we've heard nothing from. Never sooner than
+    # its own keepalive allows; a client with no keepalive is still expected
+    # to publish status at the period it was given.
+    def keepalive_deadline(self, session):
+        intervals = []
+        if session.keepalive:
+            intervals.append(session.keepalive * self.KeepaliveGrace)
+        if session.status_period:
+            intervals.append(session.status_period / 1000 * self.StatusGrace)
+        if not intervals:
+            return None
+        return session.last_seen + max(intervals)
 
     async def send_msg(self, writer, msg_type, flags=0, packet_ident=0, payload=b''):
         head = bytes([msg_type << 4 | flags])
@@ -163,6 +408,7 @@ class SimpleMQTTServer:
             head += bytes([packet_ident >> 8, packet_ident & 0xff])
         data = head + payload
         #logging.debug(f"    writing {len(data)} bytes: {data}")
+        session_recorder.record(REC_MQTT, DIR_OUT, writer.get_extra_info('peername'), data)
         writer.write(data)
         await writer.drain()
 
@@ -194,9 +440,11 @@ class SimpleMQTTServer:
 
         return value, bytes_read
 
-    def parse_publish(self, data):
+    def parse_publish(self, data, qos=1):
         topic_len = struct.unpack("!H", data[0:2])[0]
         topic = data[2:2 + topic_len].decode("utf-8")
+        if qos == 0 and not self.qos0_packet_ids:
+            return topic, 0, data[2 + topic_len:].decode("utf-8")
         packid = struct.unpack("!H", data[2 + topic_len:4 + topic_len])[0]
         message_start = 4 + topic_len
         message = data[message_start:].decode("utf-8")
@@ -207,10 +455,11 @@ class SimpleMQTTServer:
         topic = data[2:2 + topic_len].decode("utf-8")
         return topic
 
+    # With packid None, no packet ID is written (a spec QoS 0 publish)
     def encode_publish(self, topic, message, packid=0):
         topic_len = len(topic)
         topic = topic.encode("utf-8")
-        packid = struct.pack("!H", packid)
+        packid = struct.pack("!H", packid) if packid is not None else b''
         message = message.encode("utf-8")
         return struct.pack("!H", topic_len) + topic + packid + message
     
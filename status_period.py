@@ -0,0 +1,143 @@
+#
+# Cassini
+#
+# Copyright (C) 2023 Vladimir Vukicevic
+# License: MIT
+#
+
+import logging
+import time
+
+from saturn_printer import CurrentStatus, PrintInfoStatus
+
+# Phases a printer can be in, as far as status reporting is concerned
+PHASE_TRANSFER = 'transfer'
+PHASE_FIRST_LAYERS = 'first-layers'
+PHASE_PRINTING = 'printing'
+PHASE_IDLE = 'idle'
+
+# Picks the status reporting period (SET_MYSTERY_TIME_PERIOD) for each
+# printer from what it's doing: short while a file is transferring or the
+# first layers are printing (where progress and failures matter), long when
+# it's idle or well into a print.
+#
+# One policy is shared by all the printers it manages. If budget is set, the
+# periods are stretched so that all of them together publish at most that
+# many status messages per second. The budget is shared out max-min fairly:
+# printers that want fewer messages than their share get what they want, and
+# the rest is split evenly between the ones that want more.
+class StatusPeriodPolicy:
+    Periods = {
+        PHASE_TRANSFER: 500,
+        PHASE_FIRST_LAYERS: 1000,
+        PHASE_PRINTING: 5000,
+        PHASE_IDLE: 15000,
+    }
+    FirstLayers = 10
+    MaxPeriod = 60000
+    # periods are rounded up to this, so small budget shifts don't cause a flurry of commands
+    Granularity = 250
+    # a phase set explicitly (e.g. when starting an upload) isn't overridden by
+    # an idle status for this many seconds, since the printer takes a moment to
+    # pick up the command
+    HoldTime = 10
+
+    def __init__(self, budget=None):
+        self.budget = budget
+        self.printers = {}
+        self.phases = {}
+        self.held_until = {}
+        # period last sent to each printer
+        self.assigned = {}
+
+    def phase(self, status):
+        if status is None or status['CurrentStatus'] == CurrentStatus.READY.value:
+            return PHASE_IDLE
+
+        print_info = status['PrintInfo']
+        if print_info['Status'] not in (0, PrintInfoStatus.COMPLETE.value):
+            if print_info['CurrentLayer'] < self.FirstLayers:
+                return PHASE_FIRST_LAYERS
+            return PHASE_PRINTING
+
+        file_info = status['FileTransferInfo']
+        if file_info['FileTotalSize'] > 0 and file_info['DownloadOffset'] < file_info['FileTotalSize']:
+            return PHASE_TRANSFER
+
+        return PHASE_IDLE
+
+    # Add a printer; returns the period it should be set to. Other printers'
+    # periods may be adjusted to make room in the budget.
+    def register(self, printer):
+        if printer.id in self.printers:
+            # a new SaturnPrinter taking over for the same printer
+            self.printers[printer.id] = printer
+            return self.assigned[printer.id]
+
+        self.printers[printer.id] = printer
+        self.phases[printer.id] = self.phase(printer.desc['Data']['Status'])
+        periods = self.periods()
+        self.assigned[printer.id] = periods[printer.id]
+        self.apply(periods)
+        return periods[printer.id]
+
+    def unregister(self, printer):
+        for d in (self.printers, self.phases, self.held_until, self.assigned):
+            d.pop(printer.id, None)
+        self.apply(self.periods())
+
+    # Update a printer's phase, from a status update or explicitly
+    def update(self, printer, status=None, phase=None):
+        if printer.id not in self.printers:
+            return
+
+        now = time.monotonic()
+        if phase is not None:
+            self.held_until[printer.id] = now + self.HoldTime
+        else:
+            phase = self.phase(status)
+            if phase == PHASE_IDLE and self.held_until.get(printer.id, 0) > now:
+                return
+
+        if self.phases[printer.id] == phase:
+            return
+        logging.debug(f"Printer {printer.id} status phase {self.phases[printer.id]} -> {phase}")
+        self.phases[printer.id] = phase
+        self.apply(self.periods())
+
+    def transfer_starting(self, printer):
+        self.update(printer, phase=PHASE_TRANSFER)
+
+    def print_starting(self, printer):
+        self.update(printer, phase=PHASE_FIRST_LAYERS)
+
+    def periods(self):
+        wanted = { pid: self.Periods[phase] for pid, phase in self.phases.items() }
+        if self.budget is None:
+            return wanted
+
+        # water-fill: go from the printers wanting the fewest messages to the most
+        periods = {}
+        remaining = self.budget
+        order = sorted(wanted, key=lambda pid: wanted[pid], reverse=True)
+        for i, pid in enumerate(order):
+            share = remaining / (len(order) - i)
+            rate = min(1000 / wanted[pid], share)
+            remaining -= rate
+            period = max(wanted[pid], 1000 / rate) if rate > 0 else self.MaxPeriod
+            period = -(-period // self.Granularity) * self.Granularity
+            periods[pid] = int(min(period, self.MaxPeriod))
+        return periods
+
+    def apply(self, periods):
+        changed = False
+        for pid, period in periods.items():
+            if self.assigned.get(pid) != period:
+                self.assigned[pid] = period
+                self.printers[pid].set_status_period(period)
+                changed = True
+        if changed:
+            logging.debug(f"Status periods now {self.assigned}, {self.message_rate():.2f} messages/s in total")
+
+    def message_rate(self):
+        return sum(1000 / p for p in self.assigned.values())
@@ -0,0 +1,163 @@
+#
+# Cassini
+#
+# Copyright (C) 2023 Vladimir Vukicevic
+# License: MIT
+#
+
+import logging
+import asyncio
+import json
+import random
+
+import session_recorder
+from saturn_printer import SaturnPrinter, SATURN_UDP_PORT
+from session_recorder import DIR_IN, REC_UDP
+
+class StatusPollerProtocol(asyncio.DatagramProtocol):
+    def __init__(self, poller):
+        self.poller = poller
+
+    def datagram_received(self, data, addr):
+        self.poller.incoming(data, addr)
+
+    def error_received(self, exc):
+        # e.g. ICMP port unreachable from a host that's up but isn't a printer
+        logging.debug(f"Status poller socket error: {exc}")
+
+# Sends M99999 status requests to many printers at once over a single UDP
+# socket, and matches the replies back up by source address. Each printer
+# gets its own deadline; within it, requests are retried with jittered
+# exponential backoff. Printers that didn't answer are skipped on later
+# polls for an (also growing) while, so an offline unit doesn't cost a
+# full timeout on every sweep.
+#
+# With rate set, requests (including retries) go out at no more than that
+# many per second, so that polling a whole subnet doesn't flood it.
+class StatusPoller:
+    RetryInterval = 0.5
+    RetryJitter = 0.25
+    OfflineBackoff = 10.0
+    MaxOfflineBackoff = 300.0
+
+    def __init__(self, timeout=5, port=SATURN_UDP_PORT, rate=None):
+        self.timeout = timeout
+        self.port = port
+        self.rate = rate
+        # loop time of the next free send slot, with a rate limit
+        self.next_send = 0
+        self.transport = None
+        # ip -> futures waiting for that address' reply; overlapping polls of
+        # the same address each have their own
+        self.waiters = {}
+        # ip -> (consecutive failures, loop time before which to skip it)
+        self.offline = {}
+
+    async def open(self):
+        loop = asyncio.get_running_loop()
+        self.transport, _ = await loop.create_datagram_endpoint(
+            lambda: StatusPollerProtocol(self), local_addr=('0.0.0.0', 0), allow_broadcast=True)
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *args):
+        self.close()
+
+    def incoming(self, data, addr):
+        session_recorder.record(REC_UDP, DIR_IN, addr, data)
+        futures = [f for f in self.waiters.get(addr[0], []) if not f.done()]
+        if not futures:
+            logging.debug(f"Status poller: unexpected reply from {addr}")
+            return
+        try:
+            desc = json.loads(data.decode('utf-8'))
+        except ValueError:
+            logging.warning(f"Status poller: bad reply from {addr}")
+            return
+        for future in futures:
+            future.set_result((addr, desc))
+
+    def send(self, ip):
+        self.transport.sendto(b'M99999', (ip, self.port))
+
+    # Wait for a send slot under the rate limit
+    async def throttle(self):
+        if self.rate is None:
+            return
+        now = asyncio.get_running_loop().time()
+        slot = max(now, self.next_send)
+        self.next_send = slot + 1 / self.rate
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    # Poll one address; returns (addr, desc) or None if it didn't answer in time
+    async def poll_one(self, ip, timeout=None):
+        loop = asyncio.get_running_loop()
+        deadline = None
+        interval = self.RetryInterval
+
+        future = loop.create_future()
+        self.waiters.setdefault(ip, []).append(future)
+        try:
+            while not future.done():
+                await self.throttle()
+                now = loop.time()
+                # the deadline starts once the first request is actually sent
+                if deadline is None:
+                    deadline = now + (timeout or self.timeout)
+                elif now >= deadline:
+                    break
+                self.send(ip)
+                wait = min(deadline - now, interval * random.uniform(1 - self.RetryJitter, 1 + self.RetryJitter))
+                try:
+                    await asyncio.wait_for(asyncio.shield(future), wait)
+                except asyncio.TimeoutError:
+                    interval *= 2
+            if future.done():
+                self.offline.pop(ip, None)
+                return future.result()
+        finally:
+            self.waiters[ip].remove(future)
+            if not self.waiters[ip]:
+                del self.waiters[ip]
+
+        failures = self.offline.get(ip, (0, 0))[0] + 1
+        backoff = min(self.OfflineBackoff * 2 ** (failures - 1), self.MaxOfflineBackoff)
+        self.offline[ip] = (failures, loop.time() + backoff * random.uniform(1 - self.RetryJitter, 1))
+        logging.debug(f"Status poller: no reply from {ip}, backing off for {backoff:.0f}s")
+        return None
+
+    # Poll all the given addresses concurrently. Returns a dict of ip to
+    # (addr, desc), with None for the ones that didn't answer or are still
+    # being backed off (unless force is set).
+    async def poll(self, ips, timeout=None, force=False):
+        now = asyncio.get_running_loop().time()
+        ips = list(dict.fromkeys(ips))
+        to_poll = [ip for ip in ips if force or self.offline.get(ip, (0, 0))[1] <= now]
+        results = await asyncio.gather(*[self.poll_one(ip, timeout) for ip in to_poll])
+        polled = dict(zip(to_poll, results))
+        return { ip: polled.get(ip) for ip in ips }
+
+    # Refresh the given SaturnPrinters in place; returns the ones that answered
+    async def refresh(self, printers, timeout=None, force=False):
+        results = await self.poll([p.addr[0] for p in printers], timeout, force)
+        refreshed = []
+        for p in printers:
+            result = results[p.addr[0]]
+            if result is not None:
+                p.set_desc(result[1])
+                refreshed.append(p)
+        return refreshed
+
+    # Find printers at the given addresses; returns SaturnPrinter objects for
+    # the ones that answered
+    async def find_printers(self, ips, timeout=None):
+        results = await self.poll(ips, timeout, force=True)
+        return [SaturnPrinter(r[0], r[1]) for r in results.values() if r is not None]
@@ -0,0 +1,91 @@
+#
+# Cassini
+#
+# Copyright (C) 2023 Vladimir Vukicevic
+# License: MIT
+#
+# Finds simulated printers on loopback addresses. Run with pytest.
+#
+
+import asyncio
+import threading
+
+import pytest
+
+pytest.importorskip("scapy")
+
+from discovery import Discovery
+from saturn_printer import SaturnPrinter
+from printer_simulator import SimulatedPrinter
+
+HOSTS = ['127.0.3.2', '127.0.3.3', '127.0.3.5']
+
+# Simulators on HOSTS, all on one free port, as Discovery polls a single port
+async def start_simulators():
+    sims = []
+    port = 0
+    for i, host in enumerate(HOSTS):
+        sim = SimulatedPrinter(host, port, mainboard_id=f'0000discovery{i:03d}')
+        await sim.start()
+        port = sim.port
+        sims.append(sim)
+    return sims
+
+def test_sweep_finds_every_simulator():
+    async def run():
+        sims = await start_simulators()
+        try:
+            discovery = Discovery(port=sims[0].port, sweep_rate=200)
+            return await discovery.discover(networks=['127.0.3.0/29'], broadcast=False)
+        finally:
+            for sim in sims:
+                sim.stop()
+
+    printers = asyncio.run(run())
+    assert [p.addr[0] for p in printers] == HOSTS
+    assert [p.id for p in printers] == [f'0000discovery{i:03d}' for i in range(len(HOSTS))]
+
+def test_replies_are_merged_by_mainboard_id():
+    async def run():
+        sims = await start_simulators()
+        try:
+            discovery = Discovery(timeout=0.5, port=sims[0].port)
+            # the same printers answer the sweep of both (overlapping) networks
+            # and the "broadcast", which here goes to just one of them
+            return await discovery.discover(targets=[('127.0.0.1', HOSTS[0])],
+                                            networks=['127.0.3.0/30', '127.0.3.0/29'])
+        finally:
+            for sim in sims:
+                sim.stop()
+
+    printers = asyncio.run(run())
+    assert [p.addr[0] for p in printers] == HOSTS
+
+def test_sweep_refuses_huge_networks():
+    with pytest.raises(ValueError):
+        asyncio.run(Discovery().sweep(['10.0.0.0/8']))
+
+def test_find_printer_wrapper():
+    async def start():
+        sim = SimulatedPrinter('127.0.3.9', mainboard_id='0000discoveryfp0')
+        await sim.start()
+        return sim
+
+    loop = asyncio.new_event_loop()
+    try:
+        sim = loop.run_until_complete(start())
+    except OSError as e:
+        loop.close()
+        pytest.skip(f"Can't bind the printer port: {e}")
+    # the simulator answers from a thread's event loop while the wrapper runs its own
+    thread = threading.Thread(target=loop.run_forever)
+    thread.start()
+    try:
+        printer = SaturnPrinter.find_printer('127.0.3.9', timeout=2)
+        assert printer is not None and printer.id == '0000discoveryfp0'
+        assert SaturnPrinter.find_printer('127.0.3.10', timeout=0.5) is None
+    finally:
+        loop.call_soon_threadsafe(sim.stop)
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
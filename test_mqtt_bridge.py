@@ -0,0 +1,92 @@
+#
+# Cassini
+#
+# Copyright (C) 2023 Vladimir Vukicevic
+# License: MIT
+#
+# Bridges printer status to a SimpleMQTTServer standing in for an upstream
+# broker. Run with pytest.
+#
+
+import json
+import asyncio
+
+from mqtt_bridge import MQTTBridge
+from simple_mqtt_server import SimpleMQTTServer
+from simple_mqtt_client import SimpleMQTTClient
+
+PRINTER_ID = '0000bridgetest00'
+
+def status(current, layer):
+    return json.dumps({ 'Data': { 'Status': {
+        'CurrentStatus': current,
+        'PrintInfo': { 'CurrentLayer': layer, 'TotalLayer': 100 },
+    } } })
+
+async def start_server(**kwargs):
+    server = SimpleMQTTServer('127.0.0.1', 0, **kwargs)
+    await server.start()
+    task = asyncio.create_task(server.serve_forever())
+    await asyncio.sleep(0)
+    return server, task
+
+# Runs body(publish_status, upstream_server) with a bridge between a printer
+# side server and an upstream one, publishing status as a printer would
+async def with_bridge(body, min_interval):
+    mqtt, mqtt_task = await start_server()
+    broker, broker_task = await start_server(qos0_packet_ids=False)
+    printer = SimpleMQTTClient('127.0.0.1', mqtt.port, PRINTER_ID, qos0_packet_ids=True)
+    await printer.connect()
+    upstream = SimpleMQTTClient('127.0.0.1', broker.port, 'cassini-test')
+    await upstream.connect()
+
+    bridge = MQTTBridge(mqtt, upstream, prefix='test', min_interval=min_interval, flush_interval=0.05)
+    bridge_task = asyncio.create_task(bridge.run())
+
+    async def publish_status(current, layer):
+        printer.publish(f'/sdcp/status/{PRINTER_ID}', status(current, layer), qos=1)
+        await printer.flush()
+
+    try:
+        await body(publish_status, broker, bridge)
+    finally:
+        bridge_task.cancel()
+        printer.close()
+        upstream.close()
+        mqtt_task.cancel()
+        broker_task.cancel()
+
+def test_retained_value_reaches_late_subscriber():
+    received = []
+
+    async def body(publish_status, broker, bridge):
+        await publish_status(3, 1)
+        await asyncio.sleep(0.3)
+        assert broker.retained[f'test/{PRINTER_ID}/status/CurrentStatus'] == '3'
+
+        subscriber = SimpleMQTTClient('127.0.0.1', broker.port, 'subscriber')
+        subscriber.on_message = lambda topic, payload: received.append((topic, payload))
+        await subscriber.connect()
+        await subscriber.subscribe(f'test/{PRINTER_ID}/status/CurrentStatus')
+        await asyncio.sleep(0.2)
+        subscriber.close()
+
+    asyncio.run(with_bridge(body, min_interval=0))
+    assert received == [(f'test/{PRINTER_ID}/status/CurrentStatus', '3')]
+
+def test_fast_changes_are_coalesced():
+    async def body(publish_status, broker, bridge):
+        await publish_status(1, 1)
+        await asyncio.sleep(0.2)
+        for layer in range(2, 10):
+            await publish_status(1, layer)
+            await asyncio.sleep(0.02)
+        await asyncio.sleep(0.8)
+
+        assert broker.retained[f'test/{PRINTER_ID}/status/PrintInfo/CurrentLayer'] == '9'
+        stats = bridge.stats()
+        assert stats['received'] == 9
+        # three fields at first, then only the latest layer once min_interval is up
+        assert stats['published'] == 4
+
+    asyncio.run(with_bridge(body, min_interval=0.5))
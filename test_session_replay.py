@@ -0,0 +1,105 @@
+#
+# Cassini
+#
+# Copyright (C) 2023 Vladimir Vukicevic
+# License: MIT
+#
+# Records a session with a simulated printer and replays it. Run with pytest.
+#
+
+import os
+import asyncio
+import tempfile
+
+import pytest
+
+pytest.importorskip("scapy")
+
+import session_recorder
+from session_recorder import read_records, DIR_IN, REC_MQTT, REC_HTTP_REQUEST
+from session_replayer import SessionReplayer
+from simple_mqtt_server import SimpleMQTTServer, MQTT_PUBLISH
+from simple_http_server import SimpleHTTPServer
+from status_poller import StatusPoller
+from printer_simulator import SimulatedPrinter
+
+async def record_upload(log, upload_size):
+    sim = SimulatedPrinter('127.0.0.1', 0, layer_time=0.1)
+    await sim.start()
+    mqtt = SimpleMQTTServer('127.0.0.1', 0)
+    await mqtt.start()
+    mqtt_task = asyncio.create_task(mqtt.serve_forever())
+    http = SimpleHTTPServer('127.0.0.1', 0)
+    await http.start()
+    http_task = asyncio.create_task(http.serve_forever())
+    await asyncio.sleep(0)
+
+    fd, upload = tempfile.mkstemp(suffix='.goo')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(os.urandom(upload_size))
+
+    session_recorder.start(log)
+    try:
+        async with StatusPoller(port=sim.port) as poller:
+            [printer] = await poller.find_printers(['127.0.0.1'])
+        assert await printer.connect(mqtt, http)
+        async for progress in printer.upload(upload):
+            pass
+        assert progress[0] == upload_size
+
+        # a request for a file that isn't there, which should stay a 404
+        reader, writer = await asyncio.open_connection('127.0.0.1', http.port)
+        writer.write(b"GET /missing.goo HTTP/1.1\r\nHost: x\r\nConnection: close\r\n\r\n")
+        assert (await reader.read()).startswith(b"HTTP/1.1 404")
+        writer.close()
+
+        sim.stop()
+        await asyncio.sleep(0.2)
+    finally:
+        session_recorder.stop()
+        mqtt_task.cancel()
+        http_task.cancel()
+        os.unlink(upload)
+
+def recorded_counts(log):
+    frames = statuses = requests = 0
+    for t, kind, direction, addr, payload in read_records(log):
+        if direction != DIR_IN:
+            continue
+        if kind == REC_MQTT:
+            frames += 1
+            if payload[0] >> 4 == MQTT_PUBLISH and b'/sdcp/status/' in payload[:64]:
+                statuses += 1
+        elif kind == REC_HTTP_REQUEST:
+            requests += 1
+    return frames, statuses, requests
+
+def test_replay_upload(tmp_path, caplog):
+    log = str(tmp_path / 'session.rec')
+    asyncio.run(record_upload(log, 256 * 1024))
+    frames, statuses, requests = recorded_counts(log)
+    assert statuses > 0
+    assert requests >= 3
+
+    caplog.clear()
+    stats = asyncio.run(SessionReplayer(log, fast=True).replay())
+    assert "unexpected RESPONSE" not in caplog.text
+    assert stats['printers'] == 1
+    assert stats['mqtt_frames'] == frames
+    assert stats['statuses'] == statuses
+    assert stats['http_requests'] == requests
+
+def test_replay_serves_only_recorded_files(tmp_path):
+    log = str(tmp_path / 'session.rec')
+    asyncio.run(record_upload(log, 1024))
+
+    http = SimpleHTTPServer('127.0.0.1', 0)
+    replayer = SessionReplayer(log)
+    replayer.register_http_files(http)
+    try:
+        assert len(http.routes) == 1
+        assert '/missing.goo' not in http.routes
+        assert next(iter(http.routes.values()))['size'] == 1024
+    finally:
+        for name in replayer.tempfiles:
+            os.unlink(name)
@@ -0,0 +1,122 @@
+#
+# Cassini
+#
+# Copyright (C) 2023 Vladimir Vukicevic
+# License: MIT
+#
+
+import os
+import sys
+import json
+import socket
+import logging
+
+# Not exposed by the socket module everywhere it exists
+if hasattr(socket, 'TCP_NOTSENT_LOWAT'):
+    TCP_NOTSENT_LOWAT = socket.TCP_NOTSENT_LOWAT
+elif sys.platform.startswith('linux'):
+    TCP_NOTSENT_LOWAT = 25
+elif sys.platform == 'darwin':
+    TCP_NOTSENT_LOWAT = 0x201
+else:
+    TCP_NOTSENT_LOWAT = None
+
+DEFAULT_TUNING_FILE = os.path.join(os.path.expanduser('~'), '.cassini', 'tuning.json')
+
+# Socket settings for HTTP file transfers, per printer. A profile is a dict of:
+#
+#   sndbuf          SO_SNDBUF, or None for the OS default
+#   nodelay         TCP_NODELAY
+#   notsent_lowat   TCP_NOTSENT_LOWAT, or None to leave unset
+#   chunk_size      bytes read from the file and written per drain()
+#
+# Profiles are keyed by MainboardID where we know which printer is at an
+# address, or by IP address otherwise, and are saved between runs along with
+# the last throughput measured for each printer.
+class TransferTuning:
+    DefaultProfile = {
+        'sndbuf': None,
+        'nodelay': False,
+        'notsent_lowat': None,
+        'chunk_size': 1024768,
+    }
+
+    # Smoothing for the per-printer throughput average
+    ThroughputWeight = 0.3
+
+    def __init__(self, filename=DEFAULT_TUNING_FILE):
+        self.filename = filename
+        self.profiles = {}
+        self.throughput = {}
+        # ip -> MainboardID
+        self.addresses = {}
+
+    def load(self):
+        if self.filename is None or not os.path.exists(self.filename):
+            return
+        try:
+            with open(self.filename) as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            logging.warning(f"Can't read transfer tuning from {self.filename}: {e}")
+            return
+        self.profiles = data.get('profiles', {})
+        self.throughput = data.get('throughput', {})
+
+    def save(self):
+        if self.filename is None:
+            return
+        os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+        with open(self.filename, 'w') as f:
+            json.dump({ 'profiles': self.profiles, 'throughput': self.throughput }, f, indent=2)
+
+    def set_client_id(self, ip, mainboard_id):
+        self.addresses[ip] = mainboard_id
+
+    def key_for(self, ip):
+        return self.addresses.get(ip, ip)
+
+    def profile_for(self, ip):
+        profile = dict(self.DefaultProfile)
+        mainboard_id = self.addresses.get(ip)
+        if mainboard_id in self.profiles:
+            profile.update(self.profiles[mainboard_id])
+        elif ip in self.profiles:
+            profile.update(self.profiles[ip])
+        return profile
+
+    def set_profile(self, key, profile):
+        self.profiles[key] = dict(profile)
+
+    def apply(self, sock, profile):
+        if sock is None:
+            return
+        options = []
+        if profile['sndbuf'] is not None:
+            options.append((socket.SOL_SOCKET, socket.SO_SNDBUF, profile['sndbuf']))
+        if profile['nodelay']:
+            options.append((socket.IPPROTO_TCP, socket.TCP_NODELAY, 1))
+        if profile['notsent_lowat'] is not None and TCP_NOTSENT_LOWAT is not None:
+            options.append((socket.IPPROTO_TCP, TCP_NOTSENT_LOWAT, profile['notsent_lowat']))
+        for level, option, value in options:
+            try:
+                sock.setsockopt(level, option, value)
+            except OSError as e:
+                logging.debug(f"Can't set socket option {option}={value}: {e}")
+
+    # Record a finished transfer to ip of nbytes over seconds
+    def record_transfer(self, ip, nbytes, seconds):
+        if seconds <= 0 or nbytes == 0:
+            return
+        key = self.key_for(ip)
+        rate = nbytes / seconds
+        last = self.throughput.get(key)
+        if last is not None:
+            rate = last + self.ThroughputWeight * (rate - last)
+        self.throughput[key] = rate
+        logging.debug(f"Transfer to {key}: {nbytes} bytes in {seconds:.2f}s, average {rate / 1e6:.2f} MB/s")
+
+def describe_profile(profile):
+    sndbuf = profile['sndbuf'] if profile['sndbuf'] is not None else 'default'
+    lowat = profile['notsent_lowat'] if profile['notsent_lowat'] is not None else 'unset'
+    return f"sndbuf={sndbuf} nodelay={int(profile['nodelay'])} notsent_lowat={lowat} chunk={profile['chunk_size']}"